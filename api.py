@@ -1,13 +1,54 @@
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 import mysql.connector
+import mysql.connector.pooling
 from decimal import Decimal
 from evci_tool.analysis import analyze_sites
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from contextlib import contextmanager
+import os
+import threading
+import uuid
 import json
-import pandas as pd
 
 app = FastAPI()
 
+# analyses running at once, further jobs accepted while they run, and finished jobs kept for polling
+MAX_CONCURRENT_JOBS = int(os.environ.get('EVCI_MAX_CONCURRENT_JOBS', 2))
+MAX_QUEUED_JOBS = int(os.environ.get('EVCI_MAX_QUEUED_JOBS', 16))
+MAX_FINISHED_JOBS = int(os.environ.get('EVCI_MAX_FINISHED_JOBS', 256))
+
+# output files written per analysis (xlsx, json, csv, parquet), the same files as before by default;
+# results reach the database in memory, so e.g. EVCI_OUTPUT_FORMATS=xlsx skips the json files
+OUTPUT_FORMATS = os.environ.get('EVCI_OUTPUT_FORMATS', 'xlsx,json').split(',')
+
+executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_JOBS)
+jobs = OrderedDict()
+jobs_lock = threading.Lock()
+
+# connections come from a pool shared by all jobs, a job only holds one while it reads its inputs or writes its results
+DB_CONFIG = dict(
+    host="139.59.23.75",
+    port=5782,
+    user="dbadminusr",
+    password="$D3vel0per2024",
+    database="EVCI"
+)
+DB_POOL_SIZE = int(os.environ.get('EVCI_DB_POOL_SIZE', MAX_CONCURRENT_JOBS))
+# how long a job waits for a free connection when all of the pool's are borrowed
+DB_POOL_TIMEOUT = float(os.environ.get('EVCI_DB_POOL_TIMEOUT', 60))
+INSERT_BATCH_SIZE = int(os.environ.get('EVCI_INSERT_BATCH_SIZE', 1000))
+
+# set these to e.g. (lambda: sqlite3.connect(path), 'qmark') to run against a local stand-in database
+connection_factory = None
+db_paramstyle = 'format'
+
+db_pool = None
+db_pool_lock = threading.Lock()
+# one slot per pooled connection, so that borrowing waits instead of raising PoolError
+db_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+
 # Pydantic model to define input structure
 class AnalyzeRequest(BaseModel):
     analysisInput_ID: int
@@ -15,7 +56,7 @@ class AnalyzeRequest(BaseModel):
     
 
 # Default UI inputs
-ui_inputs = { 
+default_ui_inputs = { 
     "planning_scenario": "Public Places",
     "years_of_analysis": [1, 2, 3],
     "Ai": 50,
@@ -42,31 +83,63 @@ ui_inputs = {
     "plot_dendrogram": True
 }
 
-@app.post("/analyze")
-async def analyze(request: AnalyzeRequest):
-    idSelect = request.analysisInput_ID
-    filename = request.site_id
-    
-
+def get_connection():
+    global db_pool
+    if connection_factory is not None:
+        return connection_factory()
+    with db_pool_lock:
+        if db_pool is None:
+            db_pool = mysql.connector.pooling.MySQLConnectionPool(pool_name="evci", pool_size=DB_POOL_SIZE, **DB_CONFIG)
+    return db_pool.get_connection()
+
+
+def sql(query):
+    return query.replace('%s', '?') if db_paramstyle == 'qmark' else query
+
+
+def execute_batched(cursor, query, rows, batch_size=None):
+    # executemany sends each batch as one multi-row INSERT
+    batch_size = batch_size or INSERT_BATCH_SIZE
+    for k in range(0, len(rows), batch_size):
+        cursor.executemany(sql(query), rows[k:k + batch_size])
+
+
+@contextmanager
+def connection():
+    # borrowed only for the reads and for the writes of a job, not while its analysis runs
+    if not db_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise TimeoutError(f"no database connection free after {DB_POOL_TIMEOUT:g} s")
+    try:
+        mydb = get_connection()
+        try:
+            yield mydb
+        except Exception:
+            mydb.rollback()
+            raise
+        finally:
+            # hands the connection back to the pool
+            mydb.close()
+    finally:
+        db_slots.release()
+
+
+def run_analysis_job(idSelect, filename, progress=None):
+    # each job works on its own copy of the defaults
+    ui_inputs = dict(default_ui_inputs)
+    ui_inputs['output_formats'] = [f for f in OUTPUT_FORMATS if f]
+    ui_inputs['records'] = False
 
     query = "SELECT * FROM analysis_inputs WHERE id = %s;"
-    mydb = mysql.connector.connect(
-        host="139.59.23.75",
-        port=5782,
-        user="dbadminusr",
-        password="$D3vel0per2024",
-        database="EVCI"
-    )
-    mycursor = mydb.cursor()
-    mycursor.execute(query, (idSelect,))
-
-    # Retrieve column names and data
-    column_names = [i[0] for i in mycursor.description]
-    results = [{**dict(zip(column_names, row))} for row in mycursor.fetchall()]
+    with connection() as mydb:
+        mycursor = mydb.cursor()
+        mycursor.execute(sql(query), (idSelect,))
 
-    if not results:
+        # Retrieve column names and data
+        column_names = [i[0] for i in mycursor.description]
+        results = [{**dict(zip(column_names, row))} for row in mycursor.fetchall()]
         mycursor.close()
-        mydb.close()
+
+    if not results:
         return {"status": "failure","message":"analysis not generated successfully"}
 
     db_input = results[0]
@@ -127,28 +200,22 @@ async def analyze(request: AnalyzeRequest):
     # Run analysis
     
         # Run analysis
-    analysis,inputFile = analyze_sites(f'output/{idSelect}',filename, ui_inputs)
-
-
-    df = pd.read_excel(f'{inputFile}/Sites.xlsx')
-
-# Count occurrences of "PP", "FB", and "BD" in the "Site category" column
-    category_counts = df['Site category'].value_counts()
+    # result frames and site category counts are handed over in memory, the files are still written
+    analysis,inputFile,frames,category_counts = analyze_sites(f'output/{idSelect}',filename, ui_inputs, progress=progress, return_results=True)
 
 # Filter for "PP", "FB", and "BD" specifically
     pp_count = category_counts.get('PP', 0)
     fb_count = category_counts.get('FH', 0)
     bd_count = category_counts.get('BD', 0)
 
-    update_query = f"""
+    update_query = """
 UPDATE analysis_inputs
-SET publicPlaces = {pp_count}, busDepots = {bd_count}, fleetHubs = {fb_count}
-WHERE id = {idSelect};
+SET publicPlaces = %s, busDepots = %s, fleetHubs = %s
+WHERE id = %s;
 """
-    mycursor.execute(update_query)
 
     if ui_inputs["cluster"]:
-        df1Cluster= pd.read_json(f'{analysis}cluster_destination_charging_evci_analysis.json')
+        df1Cluster= frames['destination_charging']['cluster'].reset_index(drop=True)
         df1Cluster['analysis_id']=db_input['id']
         df1Cluster['outputFile']="cluster_destination_charging_evci_analysis"
         df1Cluster['createdby']=db_input['createdBy']
@@ -160,8 +227,8 @@ WHERE id = {idSelect};
 
 
 
-    df2Destination = pd.read_json(f'{analysis}initial_destination_charging_evci_analysis.json')
-    df3Intial = pd.read_json(f'{analysis}initial_opportunity_charging_evci_analysis.json')
+    df2Destination = frames['destination_charging']['initial'].reset_index(drop=True)
+    df3Intial = frames['opportunity_charging']['initial'].reset_index(drop=True)
 
 
      
@@ -187,7 +254,7 @@ WHERE id = {idSelect};
 
 
 
-    insert_query = f"""
+    response_query = f"""
 INSERT INTO analysis_responses (
     analysisInput_ID, output_for, location_name, latitude, longitude, 
     transformer_name, transformer_latitude, transformer_longitutde, transformer_distance, 
@@ -197,16 +264,14 @@ INSERT INTO analysis_responses (
 """
 
 
+    rows = []
     if ui_inputs["cluster"]:
         df1Cluster.fillna(0, inplace=True)
-        for _, row in df1Cluster.iterrows():
-            mycursor.execute(insert_query, tuple(row))
+        rows += list(df1Cluster.itertuples(index=False, name=None))
     df2Destination.fillna(0, inplace=True)
-    for _, row in df2Destination.iterrows():
-        mycursor.execute(insert_query, tuple(row))
+    rows += list(df2Destination.itertuples(index=False, name=None))
     df3Intial.fillna(0, inplace=True)
-    for _, row in df3Intial.iterrows():
-        mycursor.execute(insert_query, tuple(row))
+    rows += list(df3Intial.itertuples(index=False, name=None))
 
 
     insert_query = f"""
@@ -214,20 +279,89 @@ INSERT INTO analysis_responses (
             (site_ID, analysisInput_ID, outputFor, excelFilePath, isActive, createdBy) 
             VALUES (%s, %s, %s, %s, %s,%s)
             """
-    data = [
-                (filename, idSelect, "cluster_destination_charging_evci_analysis", analysis+"cluster_destination_charging_evci_analysis.xlsx", "1", db_input['createdBy']),
-                (filename, idSelect, "initial_destination_charging_evci_analysis", analysis+"initial_destination_charging_evci_analysis.xlsx", "1", db_input['createdBy']),
-                (filename, idSelect, "initial_opportunity_charging_evci_analysis", analysis+"initial_opportunity_charging_evci_analysis.xlsx", "1", db_input['createdBy'])
-            ]
-    for row in data:
-        mycursor.execute(insert_query, row)
-
-    mydb.commit()
-    mycursor.close()
-    mydb.close()
+    # each output is logged with its excel file if one was written, else with the first format written
+    formats = ui_inputs['output_formats']
+    ext = 'xlsx' if 'xlsx' in formats else (formats[0] if formats else None)
+    outputs = ["cluster_destination_charging_evci_analysis", "initial_destination_charging_evci_analysis", "initial_opportunity_charging_evci_analysis"]
+    data = [(filename, idSelect, output, analysis+output+"."+ext, "1", db_input['createdBy']) for output in outputs] if ext else []
+
+    # all writes are one transaction
+    with connection() as mydb:
+        mycursor = mydb.cursor()
+        mycursor.execute(sql(update_query), (int(pp_count), int(bd_count), int(fb_count), idSelect))
+        execute_batched(mycursor, response_query, rows)
+        execute_batched(mycursor, insert_query, data)
+        mydb.commit()
+        mycursor.close()
 
     return {"status":"success","message":"generated"}
 
 
     
     
+
+
+def run_job(job_id, idSelect, filename):
+    with jobs_lock:
+        job = jobs[job_id]
+
+    def progress(charging_type, prog):
+        with jobs_lock:
+            job['charging_types'][charging_type] = prog
+            job['progress'] = sum(job['charging_types'].values()) / 2
+
+    with jobs_lock:
+        job['status'] = "running"
+
+    try:
+        result = run_analysis_job(idSelect, filename, progress)
+    except HTTPException as e:
+        result = {"status": "failure", "message": e.detail}
+    except Exception as e:
+        result = {"status": "failure", "message": str(e)}
+
+    with jobs_lock:
+        job['status'] = "done" if result["status"] == "success" else "failed"
+        if result["status"] == "success":
+            job['progress'] = 100.0
+        job['result'] = result
+
+
+def get_job(job_id):
+    with jobs_lock:
+        if job_id not in jobs:
+            raise HTTPException(status_code=404, detail=f"unknown job {job_id}")
+        return dict(jobs[job_id])
+
+
+@app.post("/analyze")
+async def analyze(request: AnalyzeRequest):
+    with jobs_lock:
+        active = [k for k, j in jobs.items() if j['status'] in ("queued", "running")]
+        if len(active) >= MAX_CONCURRENT_JOBS + MAX_QUEUED_JOBS:
+            raise HTTPException(status_code=503, detail="too many analyses in progress, try again later")
+
+        # forget the oldest finished jobs
+        finished = [k for k, j in jobs.items() if j['status'] not in ("queued", "running")]
+        for k in finished[:max(0, len(finished) - MAX_FINISHED_JOBS + 1)]:
+            del jobs[k]
+
+        job_id = uuid.uuid4().hex
+        jobs[job_id] = {"status": "queued", "progress": 0.0, "charging_types": {}, "result": None}
+
+    executor.submit(run_job, job_id, request.analysisInput_ID, request.site_id)
+    return {"status": "queued", "job_id": job_id}
+
+
+@app.get("/analyze/{job_id}")
+async def analyze_status(job_id: str):
+    job = get_job(job_id)
+    return {"job_id": job_id, "status": job['status'], "progress": round(job['progress'], 1)}
+
+
+@app.get("/analyze/{job_id}/result")
+async def analyze_result(job_id: str):
+    job = get_job(job_id)
+    if job['status'] in ("queued", "running"):
+        raise HTTPException(status_code=409, detail=f"job {job_id} is still {job['status']}")
+    return job['result']
@@ -0,0 +1,231 @@
+"""Benchmarks the stages of `analyze_sites` on synthetic cities.
+
+    python benchmark.py --sites 100 1000 10000 --out results.jsonl
+
+Each city is generated from the panaji workbooks in data/sites: the sites are resampled
+and spread over a square around panaji, and transformers are scattered over the same area.
+Every stage is timed (wall and CPU) and its peak memory traced, and one JSON record per
+stage is printed (or appended to --out) so runs of different versions can be compared.
+"""
+
+import argparse, functools, json, os, platform, shutil, subprocess, sys, tempfile, time, tracemalloc
+from contextlib import contextmanager, redirect_stdout
+
+import numpy as np
+import pandas as pd
+
+import evci_tool
+from evci_tool.config import *
+from evci_tool.model import *
+from evci_tool.analysis import analyze_sites, cluster_sites, site_frame
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'sites')
+
+ui_inputs = {
+    "planning_scenario": "Public places",
+    "years_of_analysis": [1, 2, 3],
+    "Ai": 50,
+    "Li": 1500,
+    "Bipc": .25,
+    "Birate": 3.5,
+    "Eg": 5.5,
+    "backoff_factor": 1,
+    "cabling_cost": 500000,
+    "capex_2W": 2500,
+    "capex_3WS": 112000,
+    "capex_4WS": 250000,
+    "capex_4WF": 1500000,
+    "hoarding cost": 900000,
+    "kiosk_cost": 180000,
+    "year1_conversion": 0.02,
+    "year2_conversion": 0.05,
+    "year3_conversion": 0.1,
+    "holiday_percentage": 0.3,
+    "fast_charging": 0.3,
+    "slow_charging": 0.15,
+    "cluster": True,
+    "cluster_th": 0.02,
+    "plot_dendrogram": False,
+    "output_formats": [],
+    "records": False
+}
+
+
+@functools.lru_cache()
+def template(name):
+    "This function reads all sheets of a template workbook as raw cells, once."
+    # the templates declare a million empty rows, which makes them slow to read
+    return {k: v.loc[:v.last_valid_index()] for k, v in pd.read_excel(os.path.join(TEMPLATE, name), sheet_name=None, header=None).items()}
+
+def table(name):
+    "This function returns the first sheet of a template workbook as a table."
+    df = next(iter(template(name).values()))
+    return pd.DataFrame(df.iloc[1:].to_numpy(), columns=df.iloc[0]).infer_objects()
+
+def write_raw(path, sheets):
+    "This function writes sheets of raw cells to a workbook."
+    with pd.ExcelWriter(path) as w:
+        for sheet, df in sheets.items():
+            df.to_excel(w, sheet_name=sheet, header=False, index=False)
+
+def make_city(root, urban_area, n_sites, density=1.0, transformers_per_site=2.0, seed=0):
+    "This function writes the workbooks of a synthetic city with `n_sites` sites at `density` sites per km2."
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(root, urban_area), exist_ok=True)
+    write_raw(os.path.join(root, 'modelCity.xlsx'), template('model.xlsx'))
+
+    # square around panaji, in degrees
+    side = max(5.0, np.sqrt(n_sites / density))
+    lat0, lon0 = 15.49, 73.83
+    dlat, dlon = side / 111.0, side / (111.0 * np.cos(np.radians(lat0)))
+    scatter = lambda n: (lon0 + (rng.random(n) - .5) * dlon, lat0 + (rng.random(n) - .5) * dlat)
+
+    sites = table('panaji/sites.xlsx')
+    sites = sites.iloc[rng.integers(0, len(sites), n_sites)].reset_index(drop=True)
+    sites['Name'] = [f'Site {i}' for i in range(n_sites)]
+    sites['Longitude'], sites['Latitude'] = scatter(n_sites)
+    sites['Peak opportunity charging traffic'] = rng.integers(10, 200, n_sites)
+
+    grid = table('panaji/grid.xlsx')
+    n_grid = max(1, int(n_sites * transformers_per_site))
+    grid = grid.iloc[rng.integers(0, len(grid), n_grid)].reset_index(drop=True)
+    grid['Name of transformer'] = [f'Transformer {i}' for i in range(n_grid)]
+    grid['Longitude'], grid['Latitude'] = scatter(n_grid)
+
+    sites.to_excel(os.path.join(root, urban_area, 'Sites.xlsx'), sheet_name='sites', index=False)
+    grid.to_excel(os.path.join(root, urban_area, 'Grid.xlsx'), sheet_name='grid', index=False)
+    for name in ['traffic', 'parking']:
+        write_raw(os.path.join(root, urban_area, name.capitalize() + '.xlsx'), template(f'panaji/{name}.xlsx'))
+
+
+@contextmanager
+def stage(records, name, memory=True, **info):
+    "This context manager records the wall time, CPU time and peak traced memory of a stage."
+    m0 = tracemalloc.get_traced_memory()[0] if memory else 0
+    t0, c0 = time.perf_counter(), time.process_time()
+    # a span keeps the peak of this stage although the spans of analyze_sites inside it reset it
+    with collect_spans() as spans, span(name):
+        yield
+    rec = dict(stage=name, seconds=time.perf_counter() - t0, cpu_seconds=time.process_time() - c0, **info)
+    if memory: rec['peak_mb'] = m0 / 2**20 + spans[-1]['peak_mb']
+    records.append(rec)
+
+
+def read_all(urban_area):
+    "This function reads the workbooks of a city and parses all of their sheets, which are otherwise parsed on first use."
+    workbooks = setup_and_read_data(urban_area, request_id='bench')[:5]
+    for wb in workbooks:
+        for name in wb: wb[name]
+    return workbooks
+
+
+def clear_sidecars(root):
+    "This function drops the in-memory caches and the feather sidecars, so the next read parses excel."
+    clear_caches()
+    for dirpath, dirnames, _ in os.walk(root):
+        for d in [d for d in dirnames if d.endswith('.xlsx.cache')]:
+            shutil.rmtree(os.path.join(dirpath, d))
+
+
+def run_city(root, n_sites, ui_inputs, memory=True):
+    "This function times each stage of the analysis of one synthetic city."
+
+    records = []
+    info = dict(n_sites=n_sites)
+    urban_area = f'city{n_sites}'
+
+    with stage(records, 'generate', memory, **info):
+        make_city(root, urban_area, n_sites)
+
+    clear_sidecars(root)
+    with stage(records, 'read_excel', memory, **info):
+        model, site, traffic, grid, parking = read_all(urban_area)
+    clear_caches()
+    with stage(records, 'read_sidecar', memory, **info):
+        read_all(urban_area)
+    with stage(records, 'read_cached', memory, **info):
+        read_all(urban_area)
+
+    with stage(records, 'checks', memory, **info):
+        data_availability_check(model, site, traffic, grid, parking)
+        data_integrity_check(model, site, traffic, grid, parking)
+
+    with stage(records, 'grid_data', memory, **info):
+        tr_data = get_grid_data(site, grid)
+
+    for charging_type in ['opportunity_charging', 'destination_charging']:
+        info = dict(n_sites=n_sites, charging_type=charging_type)
+        with stage(records, 'globals', memory, **info):
+            r = read_globals(model, site, traffic, grid, parking, charging_type, ui_inputs)
+            r['di'] = tr_data['Transformer distance']
+            s_df = site_frame(site, tr_data, charging_type, r['scenario_code'])
+
+        with stage(records, 'run_analysis', memory, **info):
+            u_df = run_analysis(charging_type, r, s_df, backoff_factor=ui_inputs['backoff_factor'], workers=ui_inputs.get('workers', 1))
+
+        candidates = s_df.loc[u_df.utilization <= ui_inputs['cluster_th']]
+        with stage(records, 'cluster', memory, candidates=len(candidates), **info):
+            if len(candidates) > 1:
+                cluster_sites(candidates, method=ui_inputs.get('cluster_method', 'complete'), radius=ui_inputs.get('cluster_radius', 1000.0))
+
+    clear_caches()
+    with stage(records, 'analyze_sites', memory, n_sites=n_sites):
+        analyze_sites('bench', urban_area, ui_inputs)
+
+    return records
+
+
+def version():
+    "This function returns the package version and, if available, the git commit."
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return dict(version=evci_tool.__version__, commit=commit, python=platform.python_version())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sites', type=int, nargs='+', default=[100, 1000, 10000], help='city sizes to run')
+    parser.add_argument('--cluster-method', default='radius', choices=['complete', 'grid', 'radius'],
+                        help="'complete' needs O(n^2) memory, so it is not the default here")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--tile-size', type=float, help='run analyze_sites in streaming mode with tiles of this size (km)')
+    parser.add_argument('--no-memory', action='store_true', help='skip tracemalloc, which slows allocation-heavy stages')
+    parser.add_argument('--keep', help='generate the cities in this directory and keep them')
+    parser.add_argument('--out', help='append the JSON records to this file instead of printing them')
+    args = parser.parse_args(argv)
+
+    inputs = dict(ui_inputs, cluster_method=args.cluster_method, workers=args.workers)
+    if args.tile_size: inputs.update(streaming=True, tile_size=args.tile_size)
+    workdir = args.keep or tempfile.mkdtemp(prefix='evci-bench-')
+
+    # the analysis reads its inputs from ../../../media/evci/uploads/dataManagement/
+    root = os.path.join(workdir, 'media', 'evci', 'uploads', 'dataManagement')
+    cwd = os.path.join(workdir, 'a', 'b', 'c')
+    os.makedirs(root, exist_ok=True)
+    os.makedirs(cwd, exist_ok=True)
+
+    meta = version()
+    out = open(args.out, 'a') if args.out else sys.stdout
+    here = os.getcwd()
+    os.chdir(cwd)
+    if not args.no_memory: tracemalloc.start()
+    try:
+        for n in args.sites:
+            # the analysis logs to stdout, keep it apart from the records
+            with redirect_stdout(sys.stderr):
+                records = run_city(root, n, inputs, memory=not args.no_memory)
+            for rec in records:
+                out.write(json.dumps({**meta, **rec}) + '\n')
+                out.flush()
+    finally:
+        os.chdir(here)
+        if args.out: out.close()
+        if not args.keep: shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
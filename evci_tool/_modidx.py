@@ -5,21 +5,96 @@ d = { 'settings': { 'branch': 'main',
                 'doc_host': 'https://AnoopRKulkarni.github.io',
                 'git_url': 'https://github.com/AnoopRKulkarni/evci_tool/',
                 'lib_path': 'evci_tool'},
-  'syms': { 'evci_tool.analysis': { 'evci_tool.analysis.analyze_sites': ('analysis.html#analyze_sites', 'evci_tool/analysis.py'),
-                                    'evci_tool.analysis.run_episode': ('analysis.html#run_episode', 'evci_tool/analysis.py')},
-            'evci_tool.config': { 'evci_tool.config.check_files_availability': ( 'config.html#check_files_availability',
+  'syms': { 'evci_tool.analysis': { 'evci_tool.analysis._TileWriter': ('analysis.html#_tilewriter', 'evci_tool/analysis.py'),
+                                    'evci_tool.analysis._TileWriter.__init__': ( 'analysis.html#_tilewriter.__init__',
+                                                                                 'evci_tool/analysis.py'),
+                                    'evci_tool.analysis._TileWriter._csv': ('analysis.html#_tilewriter._csv', 'evci_tool/analysis.py'),
+                                    'evci_tool.analysis._TileWriter._json': ('analysis.html#_tilewriter._json', 'evci_tool/analysis.py'),
+                                    'evci_tool.analysis._TileWriter._parquet': ( 'analysis.html#_tilewriter._parquet',
+                                                                                 'evci_tool/analysis.py'),
+                                    'evci_tool.analysis._TileWriter._xlsx': ('analysis.html#_tilewriter._xlsx', 'evci_tool/analysis.py'),
+                                    'evci_tool.analysis._TileWriter.close': ('analysis.html#_tilewriter.close', 'evci_tool/analysis.py'),
+                                    'evci_tool.analysis._TileWriter.write': ('analysis.html#_tilewriter.write', 'evci_tool/analysis.py'),
+                                    'evci_tool.analysis._analyze_charging_type': ( 'analysis.html#_analyze_charging_type',
+                                                                                   'evci_tool/analysis.py'),
+                                    'evci_tool.analysis._analyze_sites': ('analysis.html#_analyze_sites', 'evci_tool/analysis.py'),
+                                    'evci_tool.analysis._branch': ('analysis.html#_branch', 'evci_tool/analysis.py'),
+                                    'evci_tool.analysis._concurrent_branches': ( 'analysis.html#_concurrent_branches',
+                                                                                 'evci_tool/analysis.py'),
+                                    'evci_tool.analysis._init_branch': ('analysis.html#_init_branch', 'evci_tool/analysis.py'),
+                                    'evci_tool.analysis._scenario_sites': ('analysis.html#_scenario_sites', 'evci_tool/analysis.py'),
+                                    'evci_tool.analysis._site_frame': ('analysis.html#_site_frame', 'evci_tool/analysis.py'),
+                                    'evci_tool.analysis._stream_episode': ('analysis.html#_stream_episode', 'evci_tool/analysis.py'),
+                                    'evci_tool.analysis._write_outputs': ('analysis.html#_write_outputs', 'evci_tool/analysis.py'),
+                                    'evci_tool.analysis.analyze_sites': ('analysis.html#analyze_sites', 'evci_tool/analysis.py'),
+                                    'evci_tool.analysis.cluster_sites': ('analysis.html#cluster_sites', 'evci_tool/analysis.py'),
+                                    'evci_tool.analysis.run_episode': ('analysis.html#run_episode', 'evci_tool/analysis.py'),
+                                    'evci_tool.analysis.site_frame': ('analysis.html#site_frame', 'evci_tool/analysis.py'),
+                                    'evci_tool.analysis.sweep_sites': ('analysis.html#sweep_sites', 'evci_tool/analysis.py')},
+            'evci_tool.config': { 'evci_tool.config.Globals': ('config.html#globals', 'evci_tool/config.py'),
+                                  'evci_tool.config.Workbook': ('config.html#workbook', 'evci_tool/config.py'),
+                                  'evci_tool.config.Workbook.__contains__': ('config.html#workbook.__contains__', 'evci_tool/config.py'),
+                                  'evci_tool.config.Workbook.__getitem__': ('config.html#workbook.__getitem__', 'evci_tool/config.py'),
+                                  'evci_tool.config.Workbook.__init__': ('config.html#workbook.__init__', 'evci_tool/config.py'),
+                                  'evci_tool.config.Workbook.__iter__': ('config.html#workbook.__iter__', 'evci_tool/config.py'),
+                                  'evci_tool.config.Workbook.__len__': ('config.html#workbook.__len__', 'evci_tool/config.py'),
+                                  'evci_tool.config.Workbook.__repr__': ('config.html#workbook.__repr__', 'evci_tool/config.py'),
+                                  'evci_tool.config._cell_kind': ('config.html#_cell_kind', 'evci_tool/config.py'),
+                                  'evci_tool.config._decode_sheet': ('config.html#_decode_sheet', 'evci_tool/config.py'),
+                                  'evci_tool.config._digest': ('config.html#_digest', 'evci_tool/config.py'),
+                                  'evci_tool.config._encode_sheet': ('config.html#_encode_sheet', 'evci_tool/config.py'),
+                                  'evci_tool.config._lru': ('config.html#_lru', 'evci_tool/config.py'),
+                                  'evci_tool.config._missing_counts': ('config.html#_missing_counts', 'evci_tool/config.py'),
+                                  'evci_tool.config._points': ('config.html#_points', 'evci_tool/config.py'),
+                                  'evci_tool.config._project': ('config.html#_project', 'evci_tool/config.py'),
+                                  'evci_tool.config._read_manifest': ('config.html#_read_manifest', 'evci_tool/config.py'),
+                                  'evci_tool.config._read_sheet': ('config.html#_read_sheet', 'evci_tool/config.py'),
+                                  'evci_tool.config._read_sidecar': ('config.html#_read_sidecar', 'evci_tool/config.py'),
+                                  'evci_tool.config._required_sheets': ('config.html#_required_sheets', 'evci_tool/config.py'),
+                                  'evci_tool.config._rss_mb': ('config.html#_rss_mb', 'evci_tool/config.py'),
+                                  'evci_tool.config._sheet_names': ('config.html#_sheet_names', 'evci_tool/config.py'),
+                                  'evci_tool.config._sidecar_manifest': ('config.html#_sidecar_manifest', 'evci_tool/config.py'),
+                                  'evci_tool.config._transformer': ('config.html#_transformer', 'evci_tool/config.py'),
+                                  'evci_tool.config._workbook_entry': ('config.html#_workbook_entry', 'evci_tool/config.py'),
+                                  'evci_tool.config._write_sidecar': ('config.html#_write_sidecar', 'evci_tool/config.py'),
+                                  'evci_tool.config.check_files_availability': ( 'config.html#check_files_availability',
                                                                                  'evci_tool/config.py'),
+                                  'evci_tool.config.collect_spans': ('config.html#collect_spans', 'evci_tool/config.py'),
+                                  'evci_tool.config.compile_globals': ('config.html#compile_globals', 'evci_tool/config.py'),
                                   'evci_tool.config.data_availability_check': ( 'config.html#data_availability_check',
                                                                                 'evci_tool/config.py'),
                                   'evci_tool.config.data_integrity_check': ('config.html#data_integrity_check', 'evci_tool/config.py'),
                                   'evci_tool.config.data_missing_check': ('config.html#data_missing_check', 'evci_tool/config.py'),
+                                  'evci_tool.config.export_spans': ('config.html#export_spans', 'evci_tool/config.py'),
                                   'evci_tool.config.get_category': ('config.html#get_category', 'evci_tool/config.py'),
                                   'evci_tool.config.get_grid_data': ('config.html#get_grid_data', 'evci_tool/config.py'),
+                                  'evci_tool.config.ingest_workbook': ('config.html#ingest_workbook', 'evci_tool/config.py'),
                                   'evci_tool.config.read_globals': ('config.html#read_globals', 'evci_tool/config.py'),
-                                  'evci_tool.config.setup_and_read_data': ('config.html#setup_and_read_data', 'evci_tool/config.py')},
+                                  'evci_tool.config.read_workbook': ('config.html#read_workbook', 'evci_tool/config.py'),
+                                  'evci_tool.config.setup_and_read_data': ('config.html#setup_and_read_data', 'evci_tool/config.py'),
+                                  'evci_tool.config.span': ('config.html#span', 'evci_tool/config.py'),
+                                  'evci_tool.config.update_globals': ('config.html#update_globals', 'evci_tool/config.py')},
             'evci_tool.maps': {'evci_tool.maps.show_map': ('maps.html#show_map', 'evci_tool/maps.py')},
-            'evci_tool.model': { 'evci_tool.model.capex': ('model.html#capex', 'evci_tool/model.py'),
+            'evci_tool.model': { 'evci_tool.model._backoff': ('model.html#_backoff', 'evci_tool/model.py'),
+                                 'evci_tool.model._energy': ('model.html#_energy', 'evci_tool/model.py'),
+                                 'evci_tool.model._init_worker': ('model.html#_init_worker', 'evci_tool/model.py'),
+                                 'evci_tool.model._progress': ('model.html#_progress', 'evci_tool/model.py'),
+                                 'evci_tool.model._run_chunk': ('model.html#_run_chunk', 'evci_tool/model.py'),
+                                 'evci_tool.model._site_key': ('model.html#_site_key', 'evci_tool/model.py'),
+                                 'evci_tool.model._site_lonlat': ('model.html#_site_lonlat', 'evci_tool/model.py'),
+                                 'evci_tool.model._stale_sites': ('model.html#_stale_sites', 'evci_tool/model.py'),
+                                 'evci_tool.model._tariff': ('model.html#_tariff', 'evci_tool/model.py'),
+                                 'evci_tool.model._tile_neighbours': ('model.html#_tile_neighbours', 'evci_tool/model.py'),
+                                 'evci_tool.model._worker_chunk': ('model.html#_worker_chunk', 'evci_tool/model.py'),
+                                 'evci_tool.model.backoff_table': ('model.html#backoff_table', 'evci_tool/model.py'),
+                                 'evci_tool.model.capex': ('model.html#capex', 'evci_tool/model.py'),
+                                 'evci_tool.model.clear_caches': ('model.html#clear_caches', 'evci_tool/model.py'),
                                  'evci_tool.model.margin': ('model.html#margin', 'evci_tool/model.py'),
+                                 'evci_tool.model.neighbours': ('model.html#neighbours', 'evci_tool/model.py'),
                                  'evci_tool.model.opex': ('model.html#opex', 'evci_tool/model.py'),
                                  'evci_tool.model.run_analysis': ('model.html#run_analysis', 'evci_tool/model.py'),
-                                 'evci_tool.model.score': ('model.html#score', 'evci_tool/model.py')}}}
+                                 'evci_tool.model.score': ('model.html#score', 'evci_tool/model.py'),
+                                 'evci_tool.model.score_all': ('model.html#score_all', 'evci_tool/model.py'),
+                                 'evci_tool.model.site_globals': ('model.html#site_globals', 'evci_tool/model.py'),
+                                 'evci_tool.model.site_tiles': ('model.html#site_tiles', 'evci_tool/model.py'),
+                                 'evci_tool.model.stream_analysis': ('model.html#stream_analysis', 'evci_tool/model.py')}}}
@@ -1,17 +1,19 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: ../03_analysis.ipynb.
 
 # %% auto 0
-__all__ = ['run_episode', 'analyze_sites']
+__all__ = ['WRITERS', 'OUTPUT_FORMATS', 'run_episode', 'cluster_sites', 'site_frame', 'analyze_sites', 'sweep_sites']
 
 # %% ../03_analysis.ipynb 4
-import re,copy
+import re,copy,itertools,contextvars
 import numpy as np
 import pandas as pd
 import geopandas as gpd
 
-import shapely
 from fastapi import HTTPException
 import os,json
+import threading
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
 from tqdm import tqdm
 
 import matplotlib.pyplot as plt
@@ -19,16 +21,115 @@ import matplotlib.pyplot as plt
 from scipy.cluster.vq import kmeans2, whiten
 from scipy.cluster.hierarchy import dendrogram, linkage
 from scipy.cluster.hierarchy import fcluster
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
 from .config import *
+from .config import _project, _points, _spans
 from .model import *
 
 import warnings
 warnings.filterwarnings("ignore")
 
+# serializes output files and figures when analyses run on several threads (e.g. API jobs),
+# and is replaced by a process-shared lock in the processes of a concurrent analysis
+_io_lock = threading.Lock()
+
+# output writers by file extension, chosen with ui_inputs['output_formats']
+WRITERS = {
+    'xlsx': lambda df, path: df.to_excel(path),
+    'json': lambda df, path: df.to_json(path, orient='records'),
+    'csv': lambda df, path: df.to_csv(path, index=False),
+    'parquet': lambda df, path: df.to_parquet(path, index=False),
+}
+OUTPUT_FORMATS = ['xlsx', 'json']
+
+# a single background thread writes all output files, in submission order
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='evci-writer')
+
+def _write_outputs(output_df,path,formats):
+    "This function writes an output dataframe in each of the given formats."
+    with _io_lock:
+        for fmt in formats:
+            with span('write_outputs', format=fmt, file=os.path.basename(path)):
+                WRITERS[fmt](output_df, path + '.' + fmt)
+
+class _TileWriter:
+    "This class appends the results of each tile to the output files, so that they are never held in memory together."
+
+    def __init__(self,path,formats,columns):
+        self.path, self.formats, self.columns = path, formats, columns
+        self.files, self.n = {}, 0
+
+    def write(self,df):
+        with _io_lock:
+            for fmt in self.formats:
+                with span('write_outputs', format=fmt, file=os.path.basename(self.path)):
+                    getattr(self, '_' + fmt)(df, self.path + '.' + fmt)
+        self.n += 1
+
+    def _xlsx(self,df,path):
+        if self.n == 0:
+            from openpyxl import Workbook
+            wb = Workbook(write_only=True)
+            self.files['xlsx'] = wb, wb.create_sheet('Sheet1')
+            self.files['xlsx'][1].append([None] + list(df.columns))
+        ws = self.files['xlsx'][1]
+        for row in df.astype(object).where(df.notna(), None).itertuples(name=None): ws.append(list(row))
+
+    def _json(self,df,path):
+        if self.n == 0:
+            self.files['json'] = open(path, 'w')
+            self.files['json'].write('[')
+        self.files['json'].write((',' if self.n else '') + df.to_json(orient='records')[1:-1])
+
+    def _csv(self,df,path):
+        if self.n == 0: self.files['csv'] = open(path, 'w', newline='')
+        df.to_csv(self.files['csv'], header=self.n == 0, index=False)
+
+    def _parquet(self,df,path):
+        import pyarrow as pa, pyarrow.parquet as pq
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self.n == 0: self.files['parquet'] = pq.ParquetWriter(path, table.schema)
+        self.files['parquet'].write_table(table.cast(self.files['parquet'].schema))
+
+    def close(self):
+        # an episode without sites still gets its (empty) output files
+        if self.n == 0: _write_outputs(pd.DataFrame(columns=self.columns),self.path,self.formats)
+        with _io_lock:
+            for fmt, f in self.files.items():
+                if fmt == 'xlsx': f[0].save(self.path + '.xlsx')
+                else:
+                    if fmt == 'json': f.write(']')
+                    f.close()
+
+def _stream_episode(charging_type,r,s_df,path,formats,backoff_factor,tile_size,cluster,stage,progress):
+    "This function scores the sites of an episode tile by tile, writing each tile's results as soon as they are ready."
+
+    cols = ['utilization','unserviced','capex','opex','margin','max vehicles','estimated vehicles']
+    inputs = [c for c in s_df.columns if c not in ['geometry'] + cols]
+
+    # only the utilization and unserviced of each site are kept, for thresholding and clustering
+    utilization, unserviced = np.full(s_df.shape[0], np.nan), np.full(s_df.shape[0], np.nan)
+    totals = dict.fromkeys(['capex','opex','margin'], 0.0)
+
+    writer = _TileWriter(path,formats,inputs + cols)
+    try:
+        for core, u_df in stream_analysis(charging_type,r,s_df,backoff_factor=backoff_factor,tile_size=tile_size,cluster=cluster,stage=stage,progress=progress):
+            output_df = s_df[inputs].iloc[core]
+            writer.write(pd.concat([output_df, u_df[cols].set_axis(output_df.index)], axis=1))
+
+            utilization[core], unserviced[core] = u_df.utilization.to_numpy(), u_df.unserviced.to_numpy()
+            for c in totals: totals[c] += u_df[c].sum()
+    finally:
+        writer.close()
+
+    return s_df.assign(utilization=utilization, unserviced=unserviced), totals
+
 # %% ../03_analysis.ipynb 5
-def run_episode(charging_type,r,ui_inputs,s_df,txt,OUTPUT_PATH,urban_area,request_id,report={},cluster_th=0,cluster=True):
-    "This function runs a full episode of analysis on a set of sites."
+def run_episode(charging_type,r,ui_inputs,s_df,txt,OUTPUT_PATH,urban_area,request_id,report={},cluster_th=0,cluster=True,previous=None,progress=None,writes=None):
+    "This function runs a full episode of analysis on a set of sites, queuing its output files on `writes` if given."
     
     print('\n' + txt.capitalize() + ' Analysis')
     print('________________\n')
@@ -43,36 +144,53 @@ def run_episode(charging_type,r,ui_inputs,s_df,txt,OUTPUT_PATH,urban_area,reques
     #@title Compute scores
 
     backoff_factor = ui_inputs['backoff_factor']
-
-    u_df = run_analysis(charging_type,r,s_df,backoff_factor=backoff_factor,sid=urban_area,aid=request_id,cluster=cluster,stage=txt)
-
-    print(f'Total capex charges = INR Cr {sum(u_df.capex)/1e7:.2f}')
-    print(f'Total opex charges = INR Cr {sum(u_df.opex)/1e7:.2f}')
-    print(f'Total Margin = INR Cr {sum(u_df.margin)/1e7:.2f}')        
+    workers = ui_inputs.get('workers', 1)
+    streaming = ui_inputs.get('streaming', False)
+
+    formats = ui_inputs.get('output_formats', OUTPUT_FORMATS)
+    unknown = set(formats) - set(WRITERS)
+    if unknown: raise ValueError(f"unknown output formats {sorted(unknown)}")
+    path = OUTPUT_PATH + '/' + txt + '_' + charging_type + '_evci_analysis'
+
+    # the stage spans of this episode, including its output writes once they are done
+    spans = report['spans'] = []
+    with collect_spans(spans):
+        if streaming:
+            # results are written tile by tile and s_u_df only gets their utilization and unserviced
+            s_u_df, totals = _stream_episode(charging_type,r,s_df,path,formats,backoff_factor,ui_inputs.get('tile_size', 20.0),cluster,txt,progress)
+        else:
+            u_df = run_analysis(charging_type,r,s_df,backoff_factor=backoff_factor,sid=urban_area,aid=request_id,cluster=cluster,stage=txt,workers=workers,previous=previous,progress=progress)
+            totals = {c: sum(u_df[c]) for c in ['capex','opex','margin']}
+
+    print(f'Total capex charges = INR Cr {totals["capex"]/1e7:.2f}')
+    print(f'Total opex charges = INR Cr {totals["opex"]/1e7:.2f}')
+    print(f'Total Margin = INR Cr {totals["margin"]/1e7:.2f}')        
 
     report["no_site"]=f'{Nc}/{total}'
-    report["capex"]=f'{sum(u_df.capex)/1e7:.2f}'
-    report["opex"]=f'{sum(u_df.opex)/1e7:.2f}'
-    report["margin"]=f'{sum(u_df.margin)/1e7:.2f}'
+    report["capex"]=f'{totals["capex"]/1e7:.2f}'
+    report["opex"]=f'{totals["opex"]/1e7:.2f}'
+    report["margin"]=f'{totals["margin"]/1e7:.2f}'
     
-    #@title Prepare data
-    s_u_df = s_df.copy()
-
-    s_u_df['utilization'] = u_df.utilization
-    s_u_df['unserviced'] = u_df.unserviced
-    s_u_df['capex'] = u_df.capex
-    s_u_df['opex'] = u_df.opex
-    s_u_df['margin'] = u_df.margin
-    s_u_df['max vehicles'] = u_df['max vehicles']
-    s_u_df['estimated vehicles'] = u_df['estimated vehicles']
-
-    #@title Save initial analysis to Excel
-    output_df = s_u_df.copy()
-    output_df.drop('geometry', axis=1, inplace=True)
+    if not streaming:
+        #@title Prepare data
+        s_u_df = s_df.copy()
+
+        s_u_df['utilization'] = u_df.utilization
+        s_u_df['unserviced'] = u_df.unserviced
+        s_u_df['capex'] = u_df.capex
+        s_u_df['opex'] = u_df.opex
+        s_u_df['margin'] = u_df.margin
+        s_u_df['max vehicles'] = u_df['max vehicles']
+        s_u_df['estimated vehicles'] = u_df['estimated vehicles']
+
+        #@title Save initial analysis to Excel
+        output_df = s_u_df.drop('geometry', axis=1)
     
-    # Save output dataframe as both xlsx and json
-    output_df.to_excel(OUTPUT_PATH + '/' + txt + '_' + charging_type + '_evci_analysis.xlsx')
-    output_df.to_json(OUTPUT_PATH + '/' + txt + '_' + charging_type + '_evci_analysis.json', orient='records')
+    # Save output dataframe in the requested formats, in the background if the caller collects the writes
+    if formats and not streaming:
+        with collect_spans(spans):
+            if writes is None: _write_outputs(output_df,path,formats)
+            else: writes.append(_writer.submit(contextvars.copy_context().run,_write_outputs,output_df,path,formats))
     
     confirmed_sites = s_u_df[s_u_df.utilization > cluster_th]
     print(f'confirmed sites with utilization > {int(cluster_th*100)}%: {confirmed_sites.shape[0]}')
@@ -82,13 +200,261 @@ def run_episode(charging_type,r,ui_inputs,s_df,txt,OUTPUT_PATH,urban_area,reques
     return s_u_df, report
 
 # %% ../03_analysis.ipynb 7
-def analyze_sites(request_id,urban_area:str, ui_inputs):
-    "The function analyzes sites specified as part of a corridor."
+def cluster_sites(candidates,method='complete',max_d=0.01,radius=1000.0):
+    "This function groups nearby candidate sites and returns their cluster labels (and the linkage for 'complete')."
+
+    if method == 'complete':
+        # complete linkage on lat/lon, cut at `max_d` degrees. Needs O(n^2) memory.
+        points = np.column_stack([candidates['Latitude'], candidates['Longitude']]).astype(float)
+        if len(points) < 2: return np.ones(len(points), dtype=int), None
+        Z = linkage (points, method='complete', metric='euclidean')
+        return fcluster(Z, t=max_d, criterion='distance'), Z
+
+    xy = _project(candidates['Longitude'], candidates['Latitude'])
+    if method == 'grid':
+        # sites falling in the same square cell of `radius` metres form a cluster
+        _, clusters = np.unique(np.floor(xy/radius).astype(np.int64), axis=0, return_inverse=True)
+    elif method == 'radius':
+        # sites chained within `radius` metres of each other form a cluster (DBSCAN with min_samples=1)
+        pairs = cKDTree(xy).query_pairs(radius, output_type='ndarray')
+        graph = coo_matrix((np.ones(len(pairs)), (pairs[:,0], pairs[:,1])), shape=(len(xy), len(xy)))
+        _, clusters = connected_components(graph, directed=False)
+    else:
+        raise ValueError(f"unknown clustering method '{method}'")
+
+    return np.asarray(clusters).ravel() + 1, None
+
+def _scenario_sites(site,scenario_code):
+    "This function selects the sites of a planning scenario as a geodataframe."
+
+    df_t = site['sites']
+    data = df_t[df_t['Site category']==scenario_code]
+    data['Name'] = data['Name']
+    data['Latitude'] = pd.to_numeric(data['Latitude'])
+    data['Longitude'] = pd.to_numeric(data['Longitude'])
+    data['geometry'] = _points(data['Longitude'], data['Latitude'])
+
+    data_df = {}
+
+    data_df = gpd.GeoDataFrame(data, geometry=data['geometry'])
+    data_df = data_df.reset_index(drop=True)
+    return data_df
+
+def _site_frame(data_df,tr_data,charging_type):
+    "This function builds the dataframe of sites to be analyzed for a charging type."
+
+    demand = {'opportunity_charging': 'Peak opportunity charging traffic',
+              'destination_charging': 'Parking lot size'}[charging_type]
+
+    n = data_df.shape[0]
+    tr_df = tr_data.iloc[:n]
+
+    s_df = pd.DataFrame({'Name': data_df['Name'].to_numpy(),
+                         'Latitude': data_df['Latitude'].to_numpy(), 
+                         'Longitude': data_df['Longitude'].to_numpy(),
+                         'Transformer name': tr_df['Transformer name'].to_numpy(),
+                         'Transformer latitude': tr_df['Transformer latitude'].to_numpy(),
+                         'Transformer longitude': tr_df['Transformer longitude'].to_numpy(),
+                         'Transformer distance': tr_df['Transformer distance'].to_numpy(),
+                         'num_vehicles': data_df[demand].to_numpy(),
+                         'year 1': data_df['Year for site recommendation'].to_numpy(),
+                         'kiosk hoarding': data_df['Hoarding/Kiosk (1 is yes & 0 is no)'].to_numpy(),
+                         'hoarding margin': data_df['Hoarding margin'].to_numpy(),
+                         'geometry': np.array(list(data_df.geometry), dtype=object)})
+
+    return s_df
+
+def site_frame(site,tr_data,charging_type,scenario_code):
+    "This function builds the dataframe of the sites of a planning scenario to be analyzed for a charging type."
+    return _site_frame(_scenario_sites(site,scenario_code),tr_data,charging_type)
+
+def _analyze_charging_type(charging_type,model,site,traffic,grid,parking,ui_inputs,OUTPUT_PATH,urban_area,request_id,progress=None,writes=None):
+    "This function runs the initial and cluster episodes of one charging type."
+
+    print('\n' + charging_type.capitalize() + ' Analysis')
+
+    main_res={}
+    report={}
+    return_analysis={}
+
+    #set variables for clustering etc from the UI
+    cluster = ui_inputs['cluster']
+    cluster_th = ui_inputs['cluster_th']
+    plot_dendrogram = ui_inputs['plot_dendrogram']
+    cluster_method = ui_inputs.get('cluster_method', 'complete')
+    cluster_radius = ui_inputs.get('cluster_radius', 1000.0)
+    streaming = ui_inputs.get('streaming', False)
+    records = ui_inputs.get('records', True) and not streaming
+
+    #read global variables here
+    with span('globals', charging_type=charging_type):
+        r = read_globals(model,site,traffic,grid,parking,charging_type,ui_inputs)
+    with span('grid_data', charging_type=charging_type):
+        tr_data = get_grid_data(site,grid)
+
+    r['di'] = tr_data['Transformer distance']
+
+    r['total'] = site['sites'].shape[0]
+    data_df = _scenario_sites(site,r['scenario_code'])
+    bb = data_df.total_bounds
+
+    s_df = _site_frame(data_df,tr_data,charging_type)
+
+    s_u_df, report_init = run_episode(charging_type,r,ui_inputs,s_df,'initial',OUTPUT_PATH,urban_area,request_id,report,cluster_th=cluster_th,cluster=cluster,progress=progress,writes=writes)
+    if records: main_res['initial_{}_df'.format(charging_type)]=json.loads(s_u_df.to_json(orient='records',default_handler=str))
+    # main_res['initial_utilization_hist']=[float("{:.5f}".format(i)) for i in s_u_df['utilization'].tolist()]
+    # main_res['initial_unserviced_hist']=[float("{:.5f}".format(i)) for i in s_u_df['unserviced'].tolist()]
+    main_res['initial_{}_utilization_hist'.format(charging_type)]=[float("{:.5f}".format(i *100)) for i in s_u_df['utilization'].replace(np.nan,0).tolist()]
+    main_res['initial_{}_unserviced_hist'.format(charging_type)]=[float("{:.5f}".format(i *100)) for i in s_u_df['unserviced'].replace(np.nan,0).tolist()]
+    main_res['initial_{}_utilization_hist_max'.format(charging_type)]=float("{:.1f}".format(round((s_u_df['utilization'].replace(np.nan,0).max()*100)+10)))
+    main_res['initial_{}_unserviced_hist_max'.format(charging_type)]=float("{:.1f}".format(round((s_u_df['unserviced'].replace(np.nan,0).max()*100)+10)))
+    bb_box=bb.tolist()
+    BB_json={
+        "nw": {"lat": bb_box[1],"lng": bb_box[0]},
+        "se": {"lat":bb_box[3],"lng":bb_box[2]}
+    }
+    main_res["map_bound_box_{}".format(charging_type)]=BB_json
+    main_res['initial_{}_analysis'.format(charging_type)]=copy.copy(report_init)
+
+    return_analysis[charging_type]={}
+    return_analysis[charging_type]['initial']=s_u_df
+    initial_s_df = s_u_df
+
+    #@title Threshold and cluster
+    clustering_candidates = s_u_df[s_u_df.utilization <= cluster_th]
+
+    if cluster and len(clustering_candidates) > 0:
+        clusters = []
+        print('candidates for clustering: ', clustering_candidates.shape[0])
+
+        if len(clustering_candidates)>1:
+            with span('clustering', charging_type=charging_type, method=cluster_method):
+                clusters, Z = cluster_sites(clustering_candidates,method=cluster_method,radius=cluster_radius)
+            if plot_dendrogram and Z is not None:
+                main_res['cluster_dendrogram']=Z.tolist()
+                with _io_lock:
+                    plt.figure(figsize=(14,8))
+                    dendrogram(Z);
+            clustered_candidates = gpd.GeoDataFrame(clustering_candidates)
+            #base = grid_df.plot(color='none', alpha=0.2, edgecolor='black', figsize=(8,8))
+            #clustered_candidates.plot(ax=base, column=clusters, legend=True)
+
+    #@title Build final list of sites
+    confirmed_sites = s_u_df[s_u_df.utilization > cluster_th]
+    print(f'confirmed sites with utilization > {int(cluster_th*100)}%: {confirmed_sites.shape[0]}')
+
+    if cluster and len(clustering_candidates) > 0:
+        val, ind = np.unique (clusters, return_index=True)
+        clustered_sites = clustered_candidates.reset_index(drop=True)
+        clustered_sites = clustered_sites.iloc[clustered_sites.index.isin(ind)]
+        origin = np.r_[confirmed_sites.index, clustered_candidates.index[clustered_sites.index]]
+        final_list_of_sites = pd.concat([confirmed_sites, clustered_sites], axis=0)
+
+        print('final list: ', final_list_of_sites.shape[0])
+        s_df = final_list_of_sites.copy()
+        s_df = s_df.reset_index(drop=True)
+
+        # only sites that lost neighbours need to be scored again
+        # each site keeps the per-site globals it had in the initial episode
+        r_clust = site_globals(r,origin)
+        previous = (origin, initial_s_df, initial_s_df) if ui_inputs.get('incremental', True) and not streaming else None
+        s_u_df, report_clust = run_episode(charging_type,r_clust,ui_inputs,s_df,'cluster',OUTPUT_PATH,urban_area,request_id,report,cluster_th=cluster_th,cluster=cluster,previous=previous,progress=progress,writes=writes)
+        return_analysis[charging_type]['cluster']=s_u_df
+        if records: main_res['cluster_{}_df'.format(charging_type)]=json.loads(s_u_df.to_json(orient='records',default_handler=str))
+        # main_res['cluster_utilization_hist']=[float("{:.5f}".format(i)) for i in s_u_df['utilization'].tolist()]
+        # main_res['cluster_unserviced_hist']=[float("{:.5f}".format(i)) for i in s_u_df['unserviced'].tolist()]
+        main_res['cluster_{}_utilization_hist'.format(charging_type)]=[float("{:.5f}".format(i*100)) for i in s_u_df['utilization'].replace(np.nan,0).tolist()]
+        main_res['cluster_{}_unserviced_hist'.format(charging_type)]=[float("{:.5f}".format(i*100)) for i in s_u_df['unserviced'].replace(np.nan,0).tolist()]
+        main_res['cluster_{}_utilization_hist_max'.format(charging_type)]=float("{:.1f}".format(round((s_u_df['utilization'].replace(np.nan,0).max()*100)+10)))
+        main_res['cluster_{}_unserviced_hist_max'.format(charging_type)]=float("{:.1f}".format(round((s_u_df['unserviced'].replace(np.nan,0).max()*100)+10)))
+        main_res['cluster_{}_analysis'.format(charging_type)]=report_clust
+        return_analysis[charging_type]['cluster']=s_u_df
+    else:
+        final_list_of_sites = confirmed_sites.copy()
+
+    return main_res, return_analysis[charging_type]
+
+# the progress queue of a charging-type process, see _init_branch
+_branch_progress = None
+
+def _init_branch(lock,progress):
+    "This function receives the output lock and progress queue shared by the charging-type processes."
+    global _io_lock, _branch_progress
+    _io_lock, _branch_progress = lock, progress
+
+def _branch(charging_type,urban_area,request_id,ui_inputs,progress):
+    "This function runs one charging type in its own process, returning its results and spans."
+    report = (lambda c, prog: _branch_progress.put((c, prog))) if progress else None
+    with collect_spans() as spans:
+        model,site,traffic,grid,parking, INPUT_PATH, OUTPUT_PATH = setup_and_read_data(urban_area, request_id=request_id)
+        writes = []
+        res, analysis = _analyze_charging_type(charging_type,model,site,traffic,grid,parking,ui_inputs,OUTPUT_PATH,urban_area,request_id,report,writes)
+        for f in writes: f.result()
+    return res, analysis, spans
+
+def _concurrent_branches(charging_types,urban_area,request_id,ui_inputs,progress):
+    "This function runs the charging types in parallel processes, passing their progress and spans on to this one."
+    # spawned processes do not inherit the writer thread or the locks of this one
+    ctx = mp.get_context('spawn')
+    q = ctx.Queue()
+    with ProcessPoolExecutor(max_workers=len(charging_types), mp_context=ctx, initializer=_init_branch, initargs=(ctx.Lock(),q)) as pool:
+        futures = [pool.submit(_branch,c,urban_area,request_id,ui_inputs,progress is not None) for c in charging_types]
+        pending = set(futures)
+        while pending and not any(f.exception() for f in futures if f.done()):
+            _, pending = wait(pending, timeout=0.1)
+            while progress is not None and not q.empty(): progress(*q.get())
+    # the processes have exited, so the rest of their progress is in the queue
+    while progress is not None and not q.empty(): progress(*q.get())
+    branches = [f.result() for f in futures]
+
+    for res, analysis, spans in branches:
+        for collector in _spans.get(): collector.extend(spans)
+    return [(res, analysis) for res, analysis, spans in branches]
+
+def analyze_sites(request_id,urban_area:str, ui_inputs, progress=None, return_results=False):
+    "The function analyzes sites specified as part of a corridor, reporting to `progress(charging_type, prog)` if given."
+
+    # ui_inputs['profile'] is 'cprofile' or 'pyinstrument', saved as profile.prof/.html next to the outputs
+    profile = ui_inputs.get('profile')
+    if profile == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif profile == 'pyinstrument':
+        from pyinstrument import Profiler
+        profiler = Profiler()
+        profiler.start()
+
+    try:
+        with collect_spans() as spans:
+            out = _analyze_sites(request_id,urban_area,ui_inputs,progress,return_results)
+    finally:
+        if profile == 'cprofile': profiler.disable()
+        elif profile == 'pyinstrument': profiler.stop()
+
+    OUTPUT_PATH = out[0]
+    if profile == 'cprofile': profiler.dump_stats(OUTPUT_PATH + 'profile.prof')
+    elif profile == 'pyinstrument':
+        with open(OUTPUT_PATH + 'profile.html', 'w') as f: f.write(profiler.output_html())
+
+    # ui_inputs['metrics'] lists the span exports to write: 'json' (spans.json) and/or 'prometheus' (metrics.prom)
+    metrics = ui_inputs.get('metrics', [])
+    for fmt, name in [('json', 'spans.json'), ('prometheus', 'metrics.prom')]:
+        if fmt in metrics:
+            with open(OUTPUT_PATH + name, 'w') as f: f.write(export_spans(spans, fmt))
+
+    return out
+
+def _analyze_sites(request_id,urban_area,ui_inputs,progress,return_results):
+    "This function runs the analysis behind `analyze_sites`."
 
     try:
         main_res={}
-        report={}
         
+        # ui_inputs['streaming'] writes the results of each tile of ui_inputs['tile_size'] km as it goes, without keeping them
+        if return_results and ui_inputs.get('streaming', False):
+            raise ValueError("streaming analysis does not keep the results, read them from the output files")
+
         #@title Read data from excel sheets
         print("Reading input files...", end="")
         model,site,traffic,grid,parking, INPUT_PATH, OUTPUT_PATH = setup_and_read_data(urban_area, request_id=request_id)
@@ -96,160 +462,81 @@ def analyze_sites(request_id,urban_area:str, ui_inputs):
 
         return_analysis = {}
 
-        #set variables for clustering etc from the UI
-        cluster = ui_inputs['cluster']
-        cluster_th = ui_inputs['cluster_th']
-        plot_dendrogram = ui_inputs['plot_dendrogram']
+        with span('checks'):
+            #check if mandatory worksheets in xlsx files are available
+            avail = data_availability_check(model,site,traffic,grid,parking)
 
-        #check if mandatory worksheets in xlsx files are available
-        avail = data_availability_check(model,site,traffic,grid,parking)
-
-        #check if any missingness
-        missing = data_integrity_check(model,site,traffic,grid,parking)
+            #check if any missingness
+            missing = data_integrity_check(model,site,traffic,grid,parking,required_only=True)
         
         #@title Read required data sheets only
         #df = gpd.read_file(INPUT_PATH + '/shape_files/' + urban_area + '.shp')
 
-        for charging_type in ['opportunity_charging','destination_charging']:
-            print('\n' + charging_type.capitalize() + ' Analysis')
-
-            #read global variables here
-            r = read_globals(model,site,traffic,grid,parking,charging_type,ui_inputs)
-            tr_data = get_grid_data(site,grid)
-
-            r['di'] = tr_data['Transformer distance']
-
-            df_t = site['sites']
-            r['total'] = df_t.shape[0]
-            data = df_t[df_t['Site category']==r['scenario_code']]
-            data['Name'] = data['Name']
-            data['Latitude'] = pd.to_numeric(data['Latitude'])
-            data['Longitude'] = pd.to_numeric(data['Longitude'])
-            data['geometry'] = [shapely.geometry.Point(xy) for xy in 
-                                zip(data['Longitude'], data['Latitude'])]
-
-            data_df = {}
-
-            data_df = gpd.GeoDataFrame(data, geometry=data['geometry'])
-            data_df = data_df.reset_index(drop=True)
-            bb = data_df.total_bounds
-            
-            s_df = pd.DataFrame(columns=['Name',
-                                        'Latitude', 
-                                        'Longitude',
-                                        'Transformer name',
-                                        'Transformer latitude',
-                                        'Transformer longitude',
-                                        'Transformer distance',
-                                        'num_vehicles',
-                                        'year 1',
-                                        'kiosk hoarding',
-                                        'hoarding margin',
-                                        'geometry'])
-
-            s_df = s_df.reset_index(drop=True)
-
-            if charging_type == 'opportunity_charging':
-                for i in range(data_df.shape[0]):
-                    s_df.loc[i] = [
-                    data_df.loc[i].Name, 
-                    data_df.loc[i].Latitude, 
-                    data_df.loc[i].Longitude,
-                    tr_data.loc[i]['Transformer name'],
-                    tr_data.loc[i]['Transformer latitude'],
-                    tr_data.loc[i]['Transformer longitude'],
-                    tr_data.loc[i]['Transformer distance'],
-                    data_df.loc[i]['Peak opportunity charging traffic'],
-                    data_df.loc[i]['Year for site recommendation'],
-                    data_df.loc[i]['Hoarding/Kiosk (1 is yes & 0 is no)'],
-                    data_df.loc[i]['Hoarding margin'],
-                    data_df.loc[i].geometry
-                    ] 
-            else:
-                for i in range(data_df.shape[0]):
-                    s_df.loc[i] = [
-                    data_df.loc[i].Name, 
-                    data_df.loc[i].Latitude, 
-                    data_df.loc[i].Longitude, 
-                    tr_data.loc[i]['Transformer name'],
-                    tr_data.loc[i]['Transformer latitude'],
-                    tr_data.loc[i]['Transformer longitude'],
-                    tr_data.loc[i]['Transformer distance'],                    
-                    data_df.loc[i]['Parking lot size'],
-                    data_df.loc[i]['Year for site recommendation'],
-                    data_df.loc[i]['Hoarding/Kiosk (1 is yes & 0 is no)'],
-                    data_df.loc[i]['Hoarding margin'],
-                    data_df.loc[i].geometry
-                    ] 
-
-            s_u_df, report_init = run_episode(charging_type,r,ui_inputs,s_df,'initial',OUTPUT_PATH,urban_area,request_id,report,cluster_th=cluster_th,cluster=cluster)
-            main_res['initial_{}_df'.format(charging_type)]=json.loads(s_u_df.to_json(orient='records',default_handler=str))
-            # main_res['initial_utilization_hist']=[float("{:.5f}".format(i)) for i in s_u_df['utilization'].tolist()]
-            # main_res['initial_unserviced_hist']=[float("{:.5f}".format(i)) for i in s_u_df['unserviced'].tolist()]
-            main_res['initial_{}_utilization_hist'.format(charging_type)]=[float("{:.5f}".format(i *100)) for i in s_u_df['utilization'].replace(np.nan,0).tolist()]
-            main_res['initial_{}_unserviced_hist'.format(charging_type)]=[float("{:.5f}".format(i *100)) for i in s_u_df['unserviced'].replace(np.nan,0).tolist()]
-            main_res['initial_{}_utilization_hist_max'.format(charging_type)]=float("{:.1f}".format(round((s_u_df['utilization'].replace(np.nan,0).max()*100)+10)))
-            main_res['initial_{}_unserviced_hist_max'.format(charging_type)]=float("{:.1f}".format(round((s_u_df['unserviced'].replace(np.nan,0).max()*100)+10)))
-            bb_box=bb.tolist()
-            BB_json={
-                "nw": {"lat": bb_box[1],"lng": bb_box[0]},
-                "se": {"lat":bb_box[3],"lng":bb_box[2]}
-            }
-            main_res["map_bound_box_{}".format(charging_type)]=BB_json
-            main_res['initial_{}_analysis'.format(charging_type)]=copy.copy(report_init)
-
-            return_analysis[charging_type]={}
-            return_analysis[charging_type]['initial']=s_u_df
-
-            #@title Threshold and cluster
-            clustering_candidates = s_u_df[s_u_df.utilization <= cluster_th]
-            
-            if cluster and len(clustering_candidates) > 0:
-                clusters = []
-                print('candidates for clustering: ', clustering_candidates.shape[0])
-                points = np.array((clustering_candidates.apply(lambda x: list([x['Latitude'], x['Longitude']]),axis=1)).tolist())
-                
-                if len(points)>1:
-                    Z = linkage (points, method='complete', metric='euclidean');
-                    if plot_dendrogram:
-                        main_res['cluster_dendrogram']=Z.tolist()
-                        plt.figure(figsize=(14,8))
-                        dendrogram(Z);
-                    max_d = 0.01
-                    clusters = fcluster(Z, t=max_d, criterion='distance')
-                    clustered_candidates = gpd.GeoDataFrame(clustering_candidates)
-                    #base = grid_df.plot(color='none', alpha=0.2, edgecolor='black', figsize=(8,8))
-                    #clustered_candidates.plot(ax=base, column=clusters, legend=True)
-
-            #@title Build final list of sites
-            confirmed_sites = s_u_df[s_u_df.utilization > cluster_th]
-            print(f'confirmed sites with utilization > {int(cluster_th*100)}%: {confirmed_sites.shape[0]}')
-            
-            if cluster and len(clustering_candidates) > 0:
-                val, ind = np.unique (clusters, return_index=True)
-                clustered_sites = clustered_candidates.reset_index(drop=True)
-                clustered_sites = clustered_sites.iloc[clustered_sites.index.isin(ind)]
-                final_list_of_sites = pd.concat([confirmed_sites, clustered_sites], axis=0)
-
-                print('final list: ', final_list_of_sites.shape[0])
-                s_df = final_list_of_sites.copy()
-                s_df = s_df.reset_index(drop=True)
-                
-                s_u_df, report_clust = run_episode(charging_type,r,ui_inputs,s_df,'cluster',OUTPUT_PATH,urban_area,request_id,report,cluster_th=cluster_th,cluster=cluster)
-                return_analysis[charging_type]['cluster']=s_u_df
-                main_res['cluster_{}_df'.format(charging_type)]=json.loads(s_u_df.to_json(orient='records',default_handler=str))
-                # main_res['cluster_utilization_hist']=[float("{:.5f}".format(i)) for i in s_u_df['utilization'].tolist()]
-                # main_res['cluster_unserviced_hist']=[float("{:.5f}".format(i)) for i in s_u_df['unserviced'].tolist()]
-                main_res['cluster_{}_utilization_hist'.format(charging_type)]=[float("{:.5f}".format(i*100)) for i in s_u_df['utilization'].replace(np.nan,0).tolist()]
-                main_res['cluster_{}_unserviced_hist'.format(charging_type)]=[float("{:.5f}".format(i*100)) for i in s_u_df['unserviced'].replace(np.nan,0).tolist()]
-                main_res['cluster_{}_utilization_hist_max'.format(charging_type)]=float("{:.1f}".format(round((s_u_df['utilization'].replace(np.nan,0).max()*100)+10)))
-                main_res['cluster_{}_unserviced_hist_max'.format(charging_type)]=float("{:.1f}".format(round((s_u_df['unserviced'].replace(np.nan,0).max()*100)+10)))
-                main_res['cluster_{}_analysis'.format(charging_type)]=report_clust
-                return_analysis[charging_type]['cluster']=s_u_df
-            else:
-                final_list_of_sites = confirmed_sites.copy()
+        charging_types = ['opportunity_charging','destination_charging']
+        writes = []
+        args = (model,site,traffic,grid,parking,ui_inputs,OUTPUT_PATH,urban_area,request_id,progress,writes)
+
+        # ui_inputs['concurrent'] runs the charging types in two processes, each reading the (cached) workbooks itself
+        if ui_inputs.get('concurrent', False) and (os.cpu_count() or 1) > 1:
+            branches = _concurrent_branches(charging_types,urban_area,request_id,ui_inputs,progress)
+        else:
+            branches = [_analyze_charging_type(c,*args) for c in charging_types]
+
+        for charging_type, (res, analysis) in zip(charging_types, branches):
+            main_res.update(res)
+            return_analysis[charging_type] = analysis
+
+        # output files are complete (or their errors raised) before returning
+        for f in writes: f.result()
+
+        if return_results:
+            # the output frames as written to the json/xlsx files, and the number of sites per category
+            results = {c: {txt: df.drop('geometry', axis=1) for txt, df in a.items()} for c, a in return_analysis.items()}
+            category_counts = site['sites']['Site category'].value_counts().to_dict()
+            return OUTPUT_PATH,INPUT_PATH,results,category_counts
 
         return OUTPUT_PATH,INPUT_PATH
     except Exception as e:
         error_message="error in call analyze_sites(): "+str(e)
         raise HTTPException(status_code=500, detail=error_message)
+
+# %% ../03_analysis.ipynb 9
+def sweep_sites(request_id,urban_area:str,ui_inputs,overrides,charging_types=('opportunity_charging','destination_charging')):
+    "The function analyzes the sites of a corridor for many variants of the UI inputs at once."
+
+    try:
+        # a dict of lists is a grid, i.e. all combinations of its values
+        if isinstance(overrides, dict):
+            overrides = [dict(zip(overrides, v)) for v in itertools.product(*overrides.values())]
+
+        # everything that does not depend on the UI inputs is read and computed once
+        model,site,traffic,grid,parking, INPUT_PATH, OUTPUT_PATH = setup_and_read_data(urban_area, request_id=request_id)
+        tr_data = get_grid_data(site,grid)
+
+        compiled = {}
+        results = []
+        for n, override in enumerate(overrides):
+            ui = {**ui_inputs, **override}
+            for charging_type in charging_types:
+                key = (charging_type, ui['planning_scenario'])
+                if key not in compiled:
+                    r = compile_globals(model,site,traffic,grid,parking,charging_type,ui['planning_scenario'])
+                    r['di'] = tr_data['Transformer distance']
+                    base = update_globals(r,{**ui_inputs, 'planning_scenario': ui['planning_scenario']})
+                    compiled[key] = base, site_frame(site,tr_data,charging_type,r['scenario_code'])
+                base, s_df = compiled[key]
+
+                r = update_globals(base,ui,changed=set(override))
+                u_df = run_analysis(charging_type,r,s_df,backoff_factor=ui['backoff_factor'],workers=ui.get('workers', 1))
+
+                s_u_df = s_df.drop('geometry', axis=1)
+                for c in u_df.columns: s_u_df[c] = u_df[c]
+                s_u_df.insert(0, 'scenario', n)
+                s_u_df.insert(1, 'charging_type', charging_type)
+                for c, (k, v) in enumerate(override.items()): s_u_df.insert(2+c, k, [v]*s_u_df.shape[0])
+                results.append(s_u_df)
+
+        return pd.concat(results, ignore_index=True) if results else pd.DataFrame()
+    except Exception as e:
+        error_message="error in call sweep_sites(): "+str(e)
+        raise HTTPException(status_code=500, detail=error_message)
@@ -1,8 +1,10 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: ../00_config.ipynb.
 
 # %% auto 0
-__all__ = ['check_files_availability', 'setup_and_read_data', 'data_availability_check', 'data_integrity_check',
-           'data_missing_check', 'get_category', 'get_grid_data', 'read_globals']
+__all__ = ['WORKBOOK_CACHE_BYTES', 'SIDECARS', 'SCHEMA', 'check_files_availability', 'collect_spans', 'span', 'export_spans',
+           'ingest_workbook', 'Workbook', 'read_workbook', 'setup_and_read_data', 'data_availability_check',
+           'data_integrity_check', 'data_missing_check', 'get_category', 'get_grid_data', 'Globals', 'compile_globals',
+           'update_globals', 'read_globals']
 
 # %% ../00_config.ipynb 5
 import os
@@ -11,7 +13,24 @@ import pandas as pd
 import json
 from fastapi import HTTPException
 import geopandas as gpd
-import shapely
+import pyproj
+import functools
+import hashlib
+import threading
+import time
+import tracemalloc
+import contextvars
+from contextlib import contextmanager
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Dict, List, TypedDict
+from scipy.spatial import cKDTree
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    pa = feather = None
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -32,6 +51,273 @@ def check_files_availability(urban_area:str, input_path="../../../media/evci/upl
     return files_not_found
 
 # %% ../00_config.ipynb 7
+# the lists that `span` records into, one per enclosing `collect_spans`
+_spans = contextvars.ContextVar('evci_spans', default=())
+# the open spans, innermost last, each holding the highest traced memory of the spans that ended inside it
+_open_spans = contextvars.ContextVar('evci_open_spans', default=())
+
+def _rss_mb():
+    "This function returns the current resident memory of the process in MB, or NaN where /proc is not available."
+    try:
+        with open('/proc/self/statm') as f: return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/2**20
+    except (OSError, ValueError, AttributeError):
+        return float('nan')
+
+@contextmanager
+def collect_spans(spans=None):
+    "This context manager collects the spans recorded inside it, including those of nested collectors, into a (given) list."
+    spans = [] if spans is None else spans
+    token = _spans.set(_spans.get() + (spans,))
+    try:
+        yield spans
+    finally:
+        _spans.reset(token)
+
+@contextmanager
+def span(name, **labels):
+    "This context manager records the wall time, CPU time and memory of a stage, if spans are being collected."
+    collectors = _spans.get()
+    if not collectors:
+        yield
+        return
+    # the peak is reset for each stage, so a stage that ends passes its peak on to the one it ran in
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        m0, outer_peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+    frame = {'peak': 0}
+    token = _open_spans.set(_open_spans.get() + (frame,))
+    # cpu_s is the CPU time of this thread only, without the worker processes of run_analysis(workers>1)
+    t0, c0, r0 = time.perf_counter(), time.thread_time(), _rss_mb()
+    try:
+        yield
+    finally:
+        sp = {'stage': name, **labels, 'wall_s': time.perf_counter()-t0, 'cpu_s': time.thread_time()-c0,
+              'rss_mb': _rss_mb()-r0, 'peak_mb': float('nan')}
+        _open_spans.reset(token)
+        if tracing and tracemalloc.is_tracing():
+            peak = max(tracemalloc.get_traced_memory()[1], frame['peak'])
+            sp['peak_mb'] = (peak-m0)/2**20
+            if _open_spans.get():
+                parent = _open_spans.get()[-1]
+                parent['peak'] = max(parent['peak'], outer_peak, peak)
+        for spans in collectors: spans.append(sp)
+
+def export_spans(spans, fmt='json'):
+    "This function formats spans as JSON or as Prometheus metrics, summed over spans with the same labels."
+    # values that were not measured (e.g. peak_mb without tracemalloc) are NaN, written as null
+    if fmt == 'json': return json.dumps([{k: None if v != v else v for k, v in sp.items()} for sp in spans], indent=1)
+    if fmt != 'prometheus': raise ValueError(f"unknown span format '{fmt}'")
+
+    metrics = OrderedDict()
+    for sp in spans:
+        labels = ','.join(f'{k}="{v}"' for k, v in sp.items() if k not in ('wall_s','cpu_s','rss_mb','peak_mb'))
+        m = metrics.setdefault(labels, {'wall_s': 0.0, 'cpu_s': 0.0, 'rss_mb': 0.0, 'peak_mb': float('nan'), 'count': 0})
+        m['wall_s'] += sp['wall_s']; m['cpu_s'] += sp['cpu_s']; m['rss_mb'] += sp['rss_mb']; m['count'] += 1
+        m['peak_mb'] = np.fmax(m['peak_mb'], sp['peak_mb'])
+
+    lines = []
+    for metric, key, help in [('evci_stage_wall_seconds', 'wall_s', 'Wall time spent in a stage.'),
+                              ('evci_stage_cpu_seconds', 'cpu_s', 'CPU time of the thread running a stage, without worker processes.'),
+                              ('evci_stage_rss_megabytes', 'rss_mb', 'Change in resident memory of the process over a stage.'),
+                              ('evci_stage_peak_megabytes', 'peak_mb', 'Peak traced memory above the start of a stage, while tracemalloc is tracing.'),
+                              ('evci_stage_count', 'count', 'Number of times a stage ran.')]:
+        lines += [f'# HELP {metric} {help}', f'# TYPE {metric} gauge']
+        lines += [f'{metric}{{{labels}}} {m[key]}' for labels, m in metrics.items()]
+    return '\n'.join(lines) + '\n'
+
+# guards the module level caches when analyses run in threads
+_cache_lock = threading.RLock()
+
+# parsed sheets and sheet names of workbooks, keyed on (path, header) and validated against the file's mtime and size
+_workbook_cache = OrderedDict()
+WORKBOOK_CACHE_BYTES = 512*2**20
+
+# columnar (feather) copies of the uploaded workbooks are kept in a '<file>.cache' directory next to them
+SIDECARS = True
+
+def _cell_kind(v):
+    "This function classifies an excel cell as missing (0), text (1), float (2), int (3), bool (4) or date (5)."
+    if v is None or v is pd.NaT or (isinstance(v, float) and v != v): return 0
+    if isinstance(v, (bool, np.bool_)): return 4
+    if isinstance(v, (int, np.integer)): return 3
+    if isinstance(v, (float, np.floating)): return 2
+    if isinstance(v, pd.Timestamp) or hasattr(v, 'isoformat'): return 5
+    return 1
+
+def _encode_sheet(df):
+    "This function converts a sheet to an arrow table, splitting columns of mixed types into typed parts."
+    cols, labels, encoded = {}, [], []
+    for n, c in enumerate(df.columns):
+        labels.append(['int', int(c)] if isinstance(c, (int, np.integer)) else 
+                      ['float', float(c)] if isinstance(c, (float, np.floating)) else ['str', str(c)])
+        col = df[c]
+        kinds = np.array([_cell_kind(v) for v in col], dtype=np.int8) if col.dtype == object else None
+        if kinds is None or set(kinds.tolist()) <= {0, 1}:
+            cols[str(n)] = pa.array(col, from_pandas=True) if kinds is None else \
+                           pa.array(np.where(kinds == 1, col.astype(str), None), type=pa.string())
+            encoded.append(False)
+        else:
+            cols[f'{n}.s'] = pa.array([v.isoformat() if k == 5 else str(v) if k == 1 else None 
+                                       for k, v in zip(kinds, col)], type=pa.string())
+            cols[f'{n}.n'] = pa.array([float(v) if k in (2, 3, 4) else None 
+                                       for k, v in zip(kinds, col)], type=pa.float64())
+            cols[f'{n}.k'] = pa.array(kinds)
+            encoded.append(True)
+    return pa.table(cols), labels, encoded
+
+def _decode_sheet(table, labels, encoded, nrows):
+    "This function rebuilds a sheet from an arrow table written by `_encode_sheet`."
+    data = {}
+    for n, ((kind, label), enc) in enumerate(zip(labels, encoded)):
+        label = {'int': int, 'float': float, 'str': str}[kind](label)
+        if not enc:
+            data[label] = table.column(str(n)).to_pandas()
+            continue
+        text = table.column(f'{n}.s').to_pylist()
+        num = table.column(f'{n}.n').to_pylist()
+        kinds = table.column(f'{n}.k').to_pylist()
+        data[label] = pd.Series([np.nan if k == 0 else text[i] if k == 1 else num[i] if k == 2 else 
+                                 int(num[i]) if k == 3 else bool(num[i]) if k == 4 else pd.Timestamp(text[i]) 
+                                 for i, k in enumerate(kinds)], dtype=object)
+    return pd.DataFrame(data, index=pd.RangeIndex(nrows))
+
+def _sidecar_manifest(path, header):
+    return os.path.join(path + '.cache', f'manifest.h{header}.json')
+
+def _read_manifest(path, header, stamp):
+    "This function returns the sidecar manifest of a workbook, if it is up to date."
+    try:
+        with open(_sidecar_manifest(path, header)) as f: manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if tuple(manifest['source']) != tuple(stamp) or manifest['header'] != header: return None
+    # manifests written before sheets were loaded lazily always hold every sheet
+    manifest.setdefault('names', [sh['name'] for sh in manifest['sheets']])
+    return manifest
+
+# serializes the read-modify-write of sidecar manifests
+_sidecar_lock = threading.Lock()
+
+def _write_sidecar(path, header, stamp, sheets, names=None):
+    "This function writes parsed sheets of a workbook to feather files next to the workbook."
+    if feather is None: return None
+    try:
+        cache_dir = path + '.cache'
+        os.makedirs(cache_dir, exist_ok=True)
+        prefix = f'{stamp[0]}-{stamp[1]}-h{header}'
+        with _sidecar_lock:
+            manifest = _read_manifest(path, header, stamp) or \
+                       {'source': list(stamp), 'header': header, 'names': list(sheets) if names is None else list(names), 'sheets': []}
+            for name, df in sheets.items():
+                table, labels, encoded = _encode_sheet(df)
+                fname = f"{prefix}-{manifest['names'].index(name)}.feather"
+                feather.write_feather(table, os.path.join(cache_dir, fname), compression='uncompressed')
+                manifest['sheets'] = [sh for sh in manifest['sheets'] if sh['name'] != name]
+                manifest['sheets'].append({'name': name, 'file': fname, 'rows': int(df.shape[0]), 
+                                           'labels': labels, 'encoded': encoded})
+            # the manifest is swapped in last, so readers never see a partially written sidecar
+            tmp = _sidecar_manifest(path, header) + f'.{os.getpid()}.{threading.get_ident()}'
+            with open(tmp, 'w') as f: json.dump(manifest, f)
+            os.replace(tmp, _sidecar_manifest(path, header))
+        for fname in os.listdir(cache_dir):
+            if fname.endswith('.feather') and f'-h{header}-' in fname and not fname.startswith(prefix + '-'):
+                os.remove(os.path.join(cache_dir, fname))
+        return cache_dir
+    except Exception:
+        # the sidecar is only a cache, e.g. the upload directory may be read-only
+        return None
+
+def _read_sidecar(path, header, stamp, name):
+    "This function reads a sheet of a workbook from its feather sidecar, if it is there and up to date."
+    if feather is None: return None
+    try:
+        manifest = _read_manifest(path, header, stamp)
+        sh = next((sh for sh in manifest['sheets'] if sh['name'] == name), None) if manifest else None
+        if sh is None: return None
+        table = feather.read_table(os.path.join(path + '.cache', sh['file']), memory_map=True)
+        return _decode_sheet(table, sh['labels'], sh['encoded'], sh['rows'])
+    except Exception:
+        return None
+
+def ingest_workbook(path, header=0):
+    "This function converts an uploaded excel file, sheet by sheet, into feather files next to it."
+    st = os.stat(path)
+    sheets = pd.read_excel(path, sheet_name=None, header=header)
+    return _write_sidecar(path, header, (st.st_mtime_ns, st.st_size), sheets)
+
+def _workbook_entry(key, stamp):
+    "This function returns the cache entry of a workbook as of `stamp`, replacing a stale one. Call with `_cache_lock` held."
+    if key not in _workbook_cache or _workbook_cache[key]['stamp'] != stamp:
+        _workbook_cache[key] = {'stamp': stamp, 'names': None, 'sheets': {}, 'nbytes': 0}
+    _workbook_cache.move_to_end(key)
+    return _workbook_cache[key]
+
+def _sheet_names(path, header, stamp):
+    "This function lists the sheets of a workbook without parsing them."
+    key = (os.path.abspath(path), header)
+    with _cache_lock:
+        names = _workbook_entry(key, stamp)['names']
+    if names is None:
+        manifest = _read_manifest(path, header, stamp) if SIDECARS else None
+        if manifest is not None: names = manifest['names']
+        else:
+            with pd.ExcelFile(path) as xls: names = list(xls.sheet_names)
+        with _cache_lock:
+            _workbook_entry(key, stamp)['names'] = names
+    return names
+
+def _read_sheet(path, header, stamp, name, names, maxbytes):
+    "This function parses one sheet of a workbook (or reads it from the sidecar), reusing it as long as the file is unchanged."
+    key = (os.path.abspath(path), header)
+    with _cache_lock:
+        entry = _workbook_entry(key, stamp)
+        if name in entry['sheets']: return entry['sheets'][name]
+
+    # sheets are parsed on first access, so this is where the reading time of the inputs goes
+    with span('read_sheet', file=os.path.basename(path), sheet=name):
+        df = _read_sidecar(path, header, stamp, name) if SIDECARS else None
+        if df is None:
+            df = pd.read_excel(path, sheet_name=name, header=header)
+            if SIDECARS: _write_sidecar(path, header, stamp, {name: df}, names)
+
+    with _cache_lock:
+        entry = _workbook_entry(key, stamp)
+        if name not in entry['sheets']:
+            entry['sheets'][name] = df
+            entry['nbytes'] += int(df.memory_usage(deep=True).sum())
+        # evict least recently used workbooks beyond the memory cap, but always keep the newest one
+        while len(_workbook_cache) > 1 and sum(v['nbytes'] for v in _workbook_cache.values()) > maxbytes:
+            _workbook_cache.popitem(last=False)
+        return entry['sheets'][name]
+
+class Workbook(Mapping):
+    "A read-only mapping of the sheets of an excel file that parses each sheet on first access."
+
+    def __init__(self, path, header=0, maxbytes=None):
+        st = os.stat(path)
+        self.path, self.header = path, header
+        self.maxbytes = WORKBOOK_CACHE_BYTES if maxbytes is None else maxbytes
+        self.stamp = (st.st_mtime_ns, st.st_size)
+        self.names = _sheet_names(path, header, self.stamp)
+        self._sheets = {}
+
+    def __getitem__(self, name):
+        if name not in self._sheets:
+            if name not in self.names: raise KeyError(name)
+            # a private copy, so callers may modify it
+            self._sheets[name] = _read_sheet(self.path, self.header, self.stamp, name, self.names, self.maxbytes).copy()
+        return self._sheets[name]
+
+    def __contains__(self, name): return name in self.names
+    def __iter__(self): return iter(self.names)
+    def __len__(self): return len(self.names)
+    def __repr__(self): return f"Workbook({self.path!r}, sheets={self.names}, parsed={list(self._sheets)})"
+
+def read_workbook(path, header=0, maxbytes=None):
+    "This function opens an excel file as a `Workbook`, whose sheets are parsed (or read from the sidecar) when first used."
+    return Workbook(path, header, maxbytes)
+
 def setup_and_read_data(urban_area:str, input_path="../../../media/evci/uploads/dataManagement/", output_path="../../../media/evci/uploads/dataManagement/", request_id=""):
     "This function sets up paths and reads input excel files for a specified corridor"
 
@@ -50,94 +336,95 @@ def setup_and_read_data(urban_area:str, input_path="../../../media/evci/uploads/
 
           
     try:
-        model   = pd.read_excel(input_path + "modelCity.xlsx", sheet_name=None)
-        sites   = pd.read_excel(INPUT_PATH + "Sites.xlsx", sheet_name=None) 
-        traffic = pd.read_excel(INPUT_PATH + "Traffic.xlsx", sheet_name=None, header=None)
-        grid    = pd.read_excel(INPUT_PATH + "Grid.xlsx", sheet_name=None)
-        parking = pd.read_excel(INPUT_PATH + "Parking.xlsx", sheet_name=None, header=None)
+        # only lists the sheets, their parsing is recorded by the 'read_sheet' spans
+        with span('read_data'):
+            model   = read_workbook(input_path + "modelCity.xlsx")
+            sites   = read_workbook(INPUT_PATH + "Sites.xlsx") 
+            traffic = read_workbook(INPUT_PATH + "Traffic.xlsx", header=None)
+            grid    = read_workbook(INPUT_PATH + "Grid.xlsx")
+            parking = read_workbook(INPUT_PATH + "Parking.xlsx", header=None)
     except Exception as e:
         error_message="error in call setup_and_read_data(): "+str(e)
         raise HTTPException(status_code=500, detail=error_message)
     
     return model, sites, traffic, grid, parking, INPUT_PATH, OUTPUT_PATH
 
-# %% ../00_config.ipynb 12
-def data_availability_check(m,s,t,g,p): 
-    "This function checks if the excel files contain the mandatory worksheets."
-    
-    model_sheets = set(['planning_scenarios','charger_details','chargers_site_categories',
-                            'chargers_opportunity_charging', 'battery_specific', 'others'])
+# %% ../00_config.ipynb 13
+def _required_sheets(s):
+    "This function returns the worksheets the analysis needs from the model, sites, traffic, grid and parking files."
     df = s['sites']['Opportunity charging traffic profile']
-    traffic_sheets = set(df[df != 0].unique())             
-    grid_sheets = set(['grid'])
-    parking_sheets = set(s['sites']['Site category'].unique())
-    sites_sheets = set(['sites'])
+    return [set(['planning_scenarios','charger_details','chargers_site_categories',
+                 'chargers_opportunity_charging', 'battery_specific', 'others']),
+            set(['sites']),
+            set(df[df != 0].unique()),
+            set(['grid']),
+            set(s['sites']['Site category'].unique())]
+
+def data_availability_check(m,s,t,g,p): 
+    "This function checks if the excel files contain the mandatory worksheets, from the sheet names only."
     
     retval = []
     
-    if not model_sheets.issubset(set(m.keys())): retval.append('model')
-    if not sites_sheets.issubset(set(s.keys())): retval.append('sites')
-    if not traffic_sheets.issubset(set(t.keys())): retval.append('traffic')
-    if not grid_sheets.issubset(set(g.keys())): retval.append('grid')
-    if not parking_sheets.issubset(set(p.keys())): retval.append('parking')
+    for name, x, sheets in zip(['model','sites','traffic','grid','parking'], [m,s,t,g,p], _required_sheets(s)):
+        if not sheets.issubset(set(x.keys())): retval.append(name)
     
     return retval
 
-# %% ../00_config.ipynb 16
-def data_integrity_check(m,s,t,g,p, verbose=False):
-    "This function checks for integrity of excel data by checking missing values."
+# %% ../00_config.ipynb 17
+def _missing_counts(df, columns=None):
+    "This function returns the number of missing values of each column (of `columns`) that has any."
+    counts = df.isna().sum()
+    if columns is not None: counts = counts[counts.index.isin(columns)]
+    return counts[counts > 0]
+
+def data_integrity_check(m,s,t,g,p, verbose=False, required_only=False):
+    "This function checks for integrity of excel data by checking missing values, optionally of the required worksheets only."
     missing = []
+    required = _required_sheets(s) if required_only else [None]*5
     
-    for x in [m,s,t,g,p]:
+    for x, sheets in zip([m,s,t,g,p], required):
         tmpx = {}
-        for k in x.keys():
-            total = x[k].shape[0]
-            tmpx[k] = []
-            for c in x[k].columns:
-                if sum(pd.isna(x[k][c])) > 0:
-                    if verbose: 
-                        print(f"Column '{c}' of '{k}' has {sum(pd.isna(x[k][c]))}/{total} missing values")
-                    tmpx[k].append(c)
+        # with lazily loaded workbooks, checking only the required sheets leaves the others unparsed
+        for k in [k for k in x.keys() if sheets is None or k in sheets]:
+            counts = _missing_counts(x[k])
+            if verbose:
+                for c, n in counts.items():
+                    print(f"Column '{c}' of '{k}' has {n}/{x[k].shape[0]} missing values")
+            tmpx[k] = list(counts.index)
         missing.append(tmpx)
                     
     return missing
 
-# %% ../00_config.ipynb 20
+# %% ../00_config.ipynb 21
+# the columns that must not have missing values, by uploaded file and worksheet
+SCHEMA = {
+    "Sites.xlsx": {'sites': ["Name","Longitude","Latitude","type of site","Traffic congestion (4 if in city & 2 if on highway)",
+            "Year for Site recommendation Hoarding/Kiosk (1 is yes & 0 is no)","Hoarding margin Kiosk margin Available area (in sqm)","Upfront cost per sqm (land)",
+            "Yearly cost per sqm (land)","Upfront cost per sqm (kiosk)","Yearly cost per sqm (kiosk)","Upfront cost per sqm (hoarding)",
+            "Yearly cost per sqm (hoarding)","Battery swap available (1 is yes and 0 is no)"]},
+    "Grid.xlsx": {'grid': ["Name of transformer","Address","Longitude","Latitude","Tariff","Power Outage","Available load"]},
+    "Traffic.xlsx": {'profile': ["Name","vehicles"]},
+}
+
 def data_missing_check(sid,file,input_path="../../../media/evci/uploads/dataManagement/"):
     """Function checks for missing values in the excel data"""
     try:
         path = input_path+sid+"/"+file
-        columns_to_check=[]
-        sheet=""
-        if file=="Sites.xlsx": 
-            sheet='sites'
-            columns_to_check=["Name","Longitude","Latitude","type of site","Traffic congestion (4 if in city & 2 if on highway)",
-            "Year for Site recommendation Hoarding/Kiosk (1 is yes & 0 is no)","Hoarding margin Kiosk margin Available area (in sqm)","Upfront cost per sqm (land)",
-            "Yearly cost per sqm (land)","Upfront cost per sqm (kiosk)","Yearly cost per sqm (kiosk)","Upfront cost per sqm (hoarding)",
-            "Yearly cost per sqm (hoarding)","Battery swap available (1 is yes and 0 is no)"]
-        elif file=="Grid.xlsx":
-            sheet='grid'
-            columns_to_check=["Name of transformer","Address","Longitude","Latitude","Tariff","Power Outage","Available load"]
-        elif file=="Traffic.xlsx":
-            sheet='profile'
-            columns_to_check=["Name","vehicles"]
-
-        df=pd.read_excel(path,sheet_name=[sheet])
-        tmpx = {}
-        for k in df.keys():
-            tmpx= []
-            for c in df[k].columns:
-                if c in columns_to_check:
-                    if sum(pd.isna(df[k][c])) > 0:
-                        tmpx.append(c)
+        if file not in SCHEMA: raise ValueError(f"no schema for '{file}'")
+
+        # the cached workbook is shared with the analysis, so it is parsed at most once
+        wb = read_workbook(path)
+        tmpx = []
+        for sheet, columns_to_check in SCHEMA[file].items():
+            if sheet not in wb: raise ValueError(f"Worksheet named '{sheet}' not found")
+            tmpx += list(_missing_counts(wb[sheet], columns_to_check).index)
         if len(tmpx)>0:return {"missing":True,"columns":tmpx}
         else:return {"missing":False}
     except Exception as e:
         error_message="Error in call data_missing_check(): "+str(e)
         raise HTTPException(status_code=500, detail=error_message)
 
-
-# %% ../00_config.ipynb 22
+# %% ../00_config.ipynb 23
 def get_category(sid,input_path="../../../media/EVCI/uploads/dataManagement/"):
    """Function fetch site categories available in sites.xlsx file"""
    try:
@@ -149,76 +436,157 @@ def get_category(sid,input_path="../../../media/EVCI/uploads/dataManagement/"):
     error_message="error in call get_category(): "+str(e)
     raise HTTPException(status_code=500, detail=error_message)
 
-# %% ../00_config.ipynb 23
-def get_grid_data(s,g):
-    tr_lat = []
-    tr_long = []
-    tr_di = []
-    tr_name = []
+# %% ../00_config.ipynb 24
+def _lru(cache,key,value,maxsize):
+    "This function inserts a value into an LRU cache, evicting the oldest entries beyond `maxsize`."
+    cache[key] = value
+    while len(cache) > maxsize: cache.popitem(last=False)
+    return value
+
+def _digest(df):
+    "This function returns a content hash of a dataframe."
+    return hashlib.sha1(pd.util.hash_pandas_object(df, index=False).values.tobytes()).hexdigest()
+
+def _points(lon,lat):
+    "This function builds an object array of shapely points from lon/lat arrays."
+    return np.array(gpd.points_from_xy(np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)), dtype=object)
+
+@functools.lru_cache()
+def _transformer():
+    "This function returns the (thread-safe) lon/lat to EPSG:5234 transformer."
+    return pyproj.Transformer.from_crs('EPSG:4326', 'EPSG:5234', always_xy=True)
+
+_xy_cache = OrderedDict()
+
+def _project(lon,lat,maxsize=16):
+    "This function projects lon/lat (EPSG:4326) to metric x/y (EPSG:5234) as a read-only (N,2) array, cached on the coordinates."
+    lon, lat = np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)
+    key = hashlib.sha1(np.column_stack([lon, lat]).tobytes()).hexdigest()
+    with _cache_lock:
+        if key in _xy_cache:
+            _xy_cache.move_to_end(key)
+            return _xy_cache[key]
+
+    # computed outside the lock, two threads missing at once both compute the same value
+    xy = np.column_stack(_transformer().transform(lon, lat))
+    xy.flags.writeable = False
+    with _cache_lock: return _lru(_xy_cache, key, xy, maxsize)
+
+_grid_cache = OrderedDict()
+
+def get_grid_data(s,g,maxsize=8):
+    "This function finds the nearest transformer of each site and its distance in km."
     
     try:
         if g['grid'].shape[0] == 0:
             di = [0]*s['sites'].shape[0]
             return di
         
-        data = s['sites']
-        data['geometry'] = [shapely.geometry.Point(xy) for xy in 
-                            zip(data['Longitude'], data['Latitude'])]
-
-        data_df = {}
-
-        data_df = gpd.GeoDataFrame(data, geometry=data['geometry'])
-        data_df = data_df.reset_index(drop=True)
-        
-        s_df = data.copy()
+        s_df = s['sites'].copy()
         s_df = s_df.reset_index(drop=True)
-        s_df.geometry = data_df.geometry
-
-        data = g['grid']
-        data['geometry'] = [shapely.geometry.Point(xy) for xy in 
-                            zip(data['Longitude'], data['Latitude'])]
-
-        data_df = {}
-
-        data_df = gpd.GeoDataFrame(data, geometry=data['geometry'])
-        data_df = data_df.reset_index(drop=True)
-        
-        g_df = data.copy()
-        g_df = g_df.reset_index(drop=True)
-        g_df.geometry = data_df.geometry
-
-        s_crs = gpd.GeoDataFrame(s_df, crs='EPSG:4326')
-        s_crs = s_crs.to_crs('EPSG:5234')
-
-        g_crs = gpd.GeoDataFrame(g_df, crs='EPSG:4326')
-        g_crs = g_crs.to_crs('EPSG:5234')
-        
-        for i in range(s_df.shape[0]):
-            distance_from_i = g_crs.geometry.distance(s_crs.geometry.loc[i])
-            nearest_to_i = distance_from_i.idxmin()
-            tr_lat.append(g_df.loc[nearest_to_i]['Latitude'])
-            tr_long.append(g_df.loc[nearest_to_i]['Longitude'])
-            tr_name.append(g_df.loc[nearest_to_i]['Name of transformer'])
-            tr_di.append(distance_from_i[nearest_to_i]/1e3)
+        s_df['geometry'] = _points(s_df['Longitude'], s_df['Latitude'])
+
+        g_df = g['grid'].reset_index(drop=True)
+
+        # the join only depends on the site and transformer locations, so both charging types share it
+        key = (_digest(s_df[['Longitude','Latitude']]), 
+               _digest(g_df[['Name of transformer','Longitude','Latitude']]))
+        with _cache_lock:
+            tr_df = _grid_cache.get(key)
+            if tr_df is not None: _grid_cache.move_to_end(key)
+
+        if tr_df is None:
+            s_xy = _project(s_df['Longitude'], s_df['Latitude'])
+            g_xy = _project(g_df['Longitude'], g_df['Latitude'])
+            ok = np.flatnonzero(np.isfinite(g_xy).all(axis=1))
+
+            distance, nearest = cKDTree(g_xy[ok]).query(s_xy)
+            nearest = ok[nearest]
+
+            tr_df = pd.DataFrame({
+                'Transformer name': g_df['Name of transformer'].to_numpy()[nearest],
+                'Transformer longitude': g_df['Longitude'].to_numpy()[nearest],
+                'Transformer latitude': g_df['Latitude'].to_numpy()[nearest],
+                'Transformer distance': distance/1e3
+            })
+            with _cache_lock: _lru(_grid_cache, key, tr_df, maxsize)
     except Exception as e:
         error_message="error in call read_grid_data()"+str(e)
         raise HTTPException(status_code=500, detail=error_message)
     
-    s_df['Transformer name'] = tr_name
-    s_df['Transformer longitude'] = tr_long
-    s_df['Transformer latitude'] = tr_lat
-    s_df['Transformer distance'] = tr_di
+    for c in tr_df.columns: s_df[c] = tr_df[c].to_numpy()
 
     return s_df
 
-# %% ../00_config.ipynb 26
-def read_globals(m,s,t,g,p,charging_type,ui_inputs):
-  "This function returns all global parameters read from the xlsx."
-  
-  x = json.dumps(ui_inputs)
-  ui_inputs = json.loads(x)
-
-  r = {}
+# %% ../00_config.ipynb 27
+class Globals(TypedDict, total=False):
+  "The global parameters of an analysis, compiled from the workbooks by `compile_globals` and completed by `update_globals`."
+  # the scenario and its charger types
+  scenario_code: str
+  planning_scenario: str
+  charging_type: str
+  M: List[str]
+  C: List[str]
+  charger_types: List[str]
+  N: int
+  Ng: int
+  # per charger type
+  Kj: Dict[str, int]
+  Dj: Dict[str, float]
+  Hj: Dict[str, float]
+  Qj: Dict[str, float]
+  tj: Dict[str, float]
+  Mj: Dict[str, float]
+  Gk: Dict[str, float]
+  timeslots: Dict[str, float]
+  # per site (arrays of length Nc, indexed by position)
+  Nc: int
+  Cij: Dict[str, np.ndarray]
+  di: np.ndarray
+  Gi: np.ndarray
+  Ri: np.ndarray
+  Wi: np.ndarray
+  Ai: np.ndarray
+  Li: np.ndarray
+  Bi: np.ndarray
+  CH: np.ndarray
+  CK: np.ndarray
+  MH: np.ndarray
+  MK: np.ndarray
+  total: int
+  # per charger type and timeslot
+  Er: Dict[str, np.ndarray]
+  Mr: Dict[str, np.ndarray]
+  l: Dict[str, np.ndarray]
+  Eg: Dict[str, np.ndarray]
+  Mg: Dict[str, np.ndarray]
+  djworking: Dict[str, np.ndarray]
+  djholiday: Dict[str, np.ndarray]
+  qjworking: Dict[str, np.ndarray]
+  qjholiday: Dict[str, np.ndarray]
+  # costs, shares and conversion rates
+  hoarding_cost: float
+  kiosk_cost: float
+  capex_2W: float
+  capex_3WS: float
+  capex_4WS: float
+  capex_4WF: float
+  holiday_percentage: float
+  fast_charging: float
+  slow_charging: float
+  K: List[int]
+  years_of_analysis: List[int]
+  year1_conversion: float
+  year2_conversion: float
+  year3_conversion: float
+  pj: Dict[int, float]
+  Pj: float
+
+def compile_globals(m,s,t,g,p,charging_type,planning_scenario) -> Globals:
+  "This function compiles the global parameters that only depend on the xlsx, the charging type and the planning scenario."
+
+  # per charger type fields are dicts of numpy arrays, per site fields are numpy arrays of length Nc
+  r = Globals()
 
   df_p = m['planning_scenarios']
   df_c = m['charger_details']
@@ -226,13 +594,16 @@ def read_globals(m,s,t,g,p,charging_type,ui_inputs):
   df_b = m['battery_specific']
   df_o = m['others']
   
-  scenario_code = df_p[df_p['Site categories']==ui_inputs['planning_scenario']]['Scenario code'].iloc[0]
+  scenario = df_p[df_p['Site categories']==planning_scenario]
+  r['scenario_code'] = scenario_code = scenario['Scenario code'].iloc[0]
+  r['planning_scenario'] = planning_scenario
+  r['charging_type'] = charging_type
 
   # read all other parameters from the xlsx
   
-  r['scenario_code']=scenario_code
-  r['M'] = df_p[df_p['Site categories']==ui_inputs['planning_scenario']]['Charger types'].iloc[0].split(',')
+  r['M'] = scenario['Charger types'].iloc[0].split(',')
   r['C'] = r['M']
+  r['charger_types'] = r['M']
 
   r['Kj'] = {}
   r['Dj'] = {}
@@ -243,13 +614,16 @@ def read_globals(m,s,t,g,p,charging_type,ui_inputs):
   r['Gk'] = {}
   r['Cij'] = {}
 
+  if charging_type == 'opportunity_charging':
+    bundles = s['sites']['No. of charger bundles opportunity charging'].to_numpy()
+  else:
+    bundles = s['sites']['No. of charger bundles destination charging'].to_numpy()
+  chargers = df_sc[df_sc['Site categories']==planning_scenario]
+
   for c in r['C']:
     df_t = df_c[df_c['Type of vehicle']==c]
     charger = df_t['Compatible charger'].iloc[0]
-    if charging_type == 'opportunity_charging':
-      r['Cij'][c] = [i*df_sc[(df_sc['Chargers']==charger) & (df_sc['Site categories']==ui_inputs['planning_scenario'])]['No. of chargers'].iloc[0] for i in s['sites']['No. of charger bundles opportunity charging']]
-    else:
-      r['Cij'][c] = [i*df_sc[(df_sc['Chargers']==charger) & (df_sc['Site categories']==ui_inputs['planning_scenario'])]['No. of chargers'].iloc[0] for i in s['sites']['No. of charger bundles destination charging']]
+    r['Cij'][c] = bundles * chargers[chargers['Chargers']==charger]['No. of chargers'].iloc[0]
     r['Kj'][c] = int(df_t['Capex per charger'].iloc[0].split('-')[0])
     r['Dj'][c] = df_t['Charging power'].iloc[0]
     #r['Hj'][c] = df_t['Required space per charger'].iloc[0]
@@ -266,57 +640,31 @@ def read_globals(m,s,t,g,p,charging_type,ui_inputs):
   timeslots = r['timeslots']
   
   df_t = s['sites']
-  r['Nc'] = df_t[df_t['Site category']==scenario_code].shape[0]
+  r['Nc'] = int((df_t['Site category']==scenario_code).sum())
   Nc = r['Nc']
 
-  r['Gi'] = [0]*Nc
-  r['Ri'] = [0]*Nc
-  r['Wi'] = [ui_inputs['cabling_cost']]*Nc
-  r['Ai'] = [ui_inputs['Ai']]*Nc
-  r['Li'] = [ui_inputs['Li']]*Nc
-  r['Bi'] = [ui_inputs['Bipc'] * ui_inputs['Birate'] * 24 * 365]*Nc # e.g. 25% of Rs 3.5/KWh per year
-
-  r['MH'] = [s['sites'].loc[i]['Hoarding margin'] for i in range(Nc)]
-  r['MK'] = [s['sites'].loc[i]['Kiosk margin'] for i in range(Nc)]
-
-  r['Eg'] = {k: [ui_inputs['Eg']] * int(v) for k, v in timeslots.items()}
-  r['Er'] = {k: [0] * int(v) for k, v in timeslots.items()}
-  r['Mg'] = {k: [ui_inputs['Eg'] * r['MK'][0]] * int(v) for k, v in timeslots.items()} # FIX THIS index 0 !!
-  r['Mr'] = {k: [0] * int(v) for k, v in timeslots.items()}
-  r['l']  = {k: [1] * int(v) for k, v in timeslots.items()}
-    
-  r['K'] = ui_inputs['years_of_analysis']
-  r['charger_types'] = r['M']
-  r['years_of_analysis'] = ui_inputs['years_of_analysis']
-  r['capex_2W']  = ui_inputs['capex_2W']
-  r['capex_3WS'] = ui_inputs['capex_3WS']
-  r['capex_4WS'] = ui_inputs['capex_4WS']
-  r['capex_4WF'] = ui_inputs['capex_4WF']
+  r['Gi'] = np.zeros(Nc, dtype=int)
+  r['Ri'] = np.zeros(Nc, dtype=int)
+
+  r['MH'] = df_t['Hoarding margin'].to_numpy()[:Nc]
+  r['MK'] = df_t['Kiosk margin'].to_numpy()[:Nc]
+
+  r['Er'] = {k: np.zeros(int(v), dtype=int) for k, v in timeslots.items()}
+  r['Mr'] = {k: np.zeros(int(v), dtype=int) for k, v in timeslots.items()}
+  r['l']  = {k: np.ones(int(v), dtype=int) for k, v in timeslots.items()}
+
   r['hoarding_cost'] = 900000
   r['kiosk_cost'] = 180000
-  r['year1_conversion'] = ui_inputs['year1_conversion']
-  r['year2_conversion'] = ui_inputs['year2_conversion']
-  r['year3_conversion'] = ui_inputs['year3_conversion']
-  r['fast_charging'] = ui_inputs['fast_charging']
-  r['slow_charging'] = ui_inputs['slow_charging']
-  r['holiday_percentage'] = ui_inputs['holiday_percentage']
-  
-  # now lets derive all other parameters that depend on the UI inputs.
-  r['CH'] = [r['hoarding_cost']]*Nc
-  r['CK'] = [r['kiosk_cost']]*Nc
-  r['pj'] = {1: r['year1_conversion'], 
-        2: r['year2_conversion'], 
-        3: r['year3_conversion']}
-
-  r['Pj'] = max(r['pj'].values()) 
+  r['CH'] = np.full(Nc, r['hoarding_cost'])
+  r['CK'] = np.full(Nc, r['kiosk_cost'])
 
   #Traffic profile/ Parking profile
-  # read hourly vehicular traffic from the traffic.xlsx or parking.xlsx depending on charging_type
+  # read hourly vehicular traffic from the traffic.xlsx or parking.xlsx depending on charging_type.
+  # Every profile overwrites the previous one, so only the last profile of the workbook is in effect.
   
   p_df = {'opportunity_charging': t, 'destination_charging': p}
 
   profiles = list(p_df[charging_type].keys())
-  djworking = {}
 
   vehicle_type = {
     "2W": "2W",
@@ -326,39 +674,80 @@ def read_globals(m,s,t,g,p,charging_type,ui_inputs):
     "Bus": "Bus",
   }
 
-  for profile in profiles:
-    avg_traffic = p_df[charging_type][profile].iloc[3:27,1].to_list()
-    avg_traffic_per_type = {}
+  if profiles:
+    tmp_df = p_df[charging_type][profiles[-1]]
+    row = lambda name: tmp_df[tmp_df[0]==name].iloc[0,1]
+
+    avg_traffic = np.asarray(tmp_df.iloc[3:27,1].to_list(), dtype=float)
+    r['holiday_percentage'] = holiday_percentage = row('holiday_percentage')
+    fast_charging = row('fast_charging')
+    slow_charging = row('slow_charging')
+
+    r['djworking'] = {}
+    r['djholiday'] = {}
+    r['qjworking'] = {}
+    r['qjholiday'] = {}
     for c in r['M']:
-      tmp_df = p_df[charging_type][profile]
-      frac = tmp_df[tmp_df[0]==vehicle_type[c]].iloc[0,1]
-      avg_traffic_per_type[c] = [i*frac for i in avg_traffic]
+      avg_traffic_per_type = avg_traffic * row(vehicle_type[c])
       # stretch or compress here based on timeslots
       if r['timeslots'][c] > 24:
-        scale = int(r['timeslots'][c]/24)
-        avg_traffic_per_type[c] = [i for i in avg_traffic_per_type[c] for _ in range(scale)]
+        avg_traffic_per_type = np.repeat(avg_traffic_per_type, int(r['timeslots'][c]/24))
       else:
-        scale = int(24/r['timeslots'][c])
-        avg_traffic_per_type[c] = avg_traffic_per_type[c][::scale]
-      djworking[c] = [np.round(i,2) for i in avg_traffic_per_type[c]]
-    r['djworking'] = djworking
-
-    djholiday = {}
-    for profile in profiles:
-      tmp_df = p_df[charging_type][profile]
-      holiday_percentage = r['holiday_percentage'] = tmp_df[tmp_df[0]=='holiday_percentage'].iloc[0,1]
-      for c in r['M']:
-        djholiday[c] = [np.round(i*holiday_percentage,2) for i in djworking[c]]
-    r['djholiday'] = djholiday
+        avg_traffic_per_type = avg_traffic_per_type[::int(24/r['timeslots'][c])]
+      r['djworking'][c] = np.round(avg_traffic_per_type,2)
+      r['djholiday'][c] = np.round(r['djworking'][c]*holiday_percentage,2)
+      r['qjworking'][c] = np.full(int(timeslots[c]), slow_charging + fast_charging)
+      r['qjholiday'][c] = np.full(int(timeslots[c]), slow_charging + fast_charging)
     
-    for profile in profiles:
-      tmp_df = p_df[charging_type][profile]
-      fast_charging = tmp_df[tmp_df[0]=='fast_charging'].iloc[0,1]
-      slow_charging = tmp_df[tmp_df[0]=='slow_charging'].iloc[0,1]
-      r['qjworking'] = {}
-      r['qjholiday'] = {}
-      for c in r['M']:
-        r['qjworking'][c] = [slow_charging + fast_charging] * int(timeslots[c])
-        r['qjholiday'][c] = [slow_charging + fast_charging] * int(timeslots[c])
+  return r
+
+def update_globals(r:Globals,ui_inputs,changed=None) -> Globals:
+  "This function returns a copy of `r` with the parameters that depend on the UI inputs (re)computed, only for the `changed` inputs if given."
+
+  x = json.dumps(ui_inputs)
+  ui_inputs = json.loads(x)
+
+  if ui_inputs['planning_scenario'] != r['planning_scenario']:
+    raise ValueError("a different planning scenario needs compile_globals()")
+
+  dirty = lambda *keys: changed is None or any(k in changed for k in keys)
+
+  r = Globals(r)
+  Nc = r['Nc']
+  timeslots = r['timeslots']
+
+  if dirty('cabling_cost'): r['Wi'] = np.full(Nc, ui_inputs['cabling_cost'])
+  if dirty('Ai'): r['Ai'] = np.full(Nc, ui_inputs['Ai'])
+  if dirty('Li'): r['Li'] = np.full(Nc, ui_inputs['Li'])
+  if dirty('Bipc', 'Birate'): 
+    r['Bi'] = np.full(Nc, ui_inputs['Bipc'] * ui_inputs['Birate'] * 24 * 365) # e.g. 25% of Rs 3.5/KWh per year
+
+  if dirty('Eg'):
+    r['Eg'] = {k: np.full(int(v), ui_inputs['Eg']) for k, v in timeslots.items()}
+    r['Mg'] = {k: np.full(int(v), ui_inputs['Eg'] * r['MK'][0]) for k, v in timeslots.items()} # FIX THIS index 0 !!
     
+  if dirty('years_of_analysis'):
+    r['K'] = ui_inputs['years_of_analysis']
+    r['years_of_analysis'] = ui_inputs['years_of_analysis']
+  for k in ['capex_2W', 'capex_3WS', 'capex_4WS', 'capex_4WF', 'fast_charging', 'slow_charging']:
+    if dirty(k): r[k] = ui_inputs[k]
+  # the traffic/parking profile takes precedence over the UI
+  if 'djholiday' not in r: r['holiday_percentage'] = ui_inputs['holiday_percentage']
+  
+  # now lets derive all other parameters that depend on the UI inputs.
+  if dirty('year1_conversion', 'year2_conversion', 'year3_conversion'):
+    r['year1_conversion'] = ui_inputs['year1_conversion']
+    r['year2_conversion'] = ui_inputs['year2_conversion']
+    r['year3_conversion'] = ui_inputs['year3_conversion']
+    r['pj'] = {1: r['year1_conversion'], 
+               2: r['year2_conversion'], 
+               3: r['year3_conversion']}
+    r['Pj'] = max(r['pj'].values()) 
+
   return r
+
+def read_globals(m,s,t,g,p,charging_type,ui_inputs) -> Globals:
+  "This function returns all global parameters read from the xlsx."
+  
+  r = compile_globals(m,s,t,g,p,charging_type,ui_inputs['planning_scenario'])
+  return update_globals(r,ui_inputs)
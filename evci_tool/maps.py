@@ -7,13 +7,13 @@ __all__ = ['show_map']
 import geopandas as gpd
 import matplotlib.pyplot as plt
 import numpy as np
-import shapely
 import os
 
 import pandas as pd
 import tqdm
 
 from .config import *
+from .config import _points
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -27,14 +27,12 @@ def show_map(urban_area:str, request_id=""):
     #s_df = gpd.read_file(INPUT_PATH + 'shape_files/' + urban_area + '.shp')
     data = get_grid_data(s,g)
 
-    data['geometry'] = [shapely.geometry.Point(xy) for xy in 
-                        zip(data['Longitude'],data['Latitude'])]
+    data['geometry'] = _points(data['Longitude'],data['Latitude'])
 
     s_df = gpd.GeoDataFrame(data, geometry=data['geometry'])
     s_df = s_df.reset_index(drop=True)
 
-    data['geometry'] = [shapely.geometry.Point(xy) for xy in 
-                        zip(data['Transformer longitude'],data['Transformer latitude'])]
+    data['geometry'] = _points(data['Transformer longitude'],data['Transformer latitude'])
 
     g_df = gpd.GeoDataFrame(data, geometry=data['geometry'])
     g_df = g_df.reset_index(drop=True)
@@ -1,7 +1,8 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: ../01_model.ipynb.
 
 # %% auto 0
-__all__ = ['score', 'capex', 'opex', 'margin', 'run_analysis']
+__all__ = ['score', 'neighbours', 'site_tiles', 'backoff_table', 'clear_caches', 'score_all', 'capex', 'opex', 'margin',
+           'site_globals', 'run_analysis', 'stream_analysis']
 
 # %% ../01_model.ipynb 3
 import numpy as np
@@ -11,9 +12,15 @@ import geopandas as gpd
 import shapely
 
 import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 
+from scipy.spatial import cKDTree
+from scipy.sparse import csr_matrix
+
 from .config import *
+from .config import _lru, _cache_lock, _project, _workbook_cache, _xy_cache, _grid_cache, _transformer
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -56,6 +63,164 @@ def score(charging_type,r,s_df,s_df_distances,j,i,hj,k,backoff=True, backoff_fac
 
     return norm_uw, norm_uh, norm_vw, norm_vh
 
+def _site_lonlat(s_df):
+    "This function returns the lon and lat arrays of the site geometries."
+    pts = gpd.GeoSeries(np.asarray(s_df['geometry'], dtype=object))
+    return pts.x.to_numpy(), pts.y.to_numpy()
+
+def _site_key(s_df):
+    "This function returns the (lon, lat) of each site, used to identify a set of sites."
+    return list(zip(*_site_lonlat(s_df)))
+
+_neighbour_cache = OrderedDict()
+
+def neighbours(s_df,radius=5.0,maxsize=8):
+    "This function returns a sparse (CSR) matrix of distances (in km) between sites closer than `radius` km."
+
+    xy = _site_key(s_df)
+
+    with _cache_lock:
+        # reuse the index of the same or a larger site set (e.g. the initial episode for the cluster one)
+        for (sites, rad) in reversed(_neighbour_cache):
+            pos, nb = _neighbour_cache[(sites, rad)]
+            if rad == radius and all(x in pos for x in xy):
+                _neighbour_cache.move_to_end((sites, rad))
+                break
+        else:
+            pos = None
+
+    if pos is not None:
+        idx = np.array([pos[x] for x in xy], dtype=int)
+        return nb[idx][:,idx]
+
+    X = _project(*_site_lonlat(s_df))
+    ok = np.flatnonzero(np.isfinite(X).all(axis=1))
+
+    pairs = cKDTree(X[ok]).query_pairs(radius*1e3*(1+1e-9), output_type='ndarray')
+    a, b = ok[pairs[:,0]], ok[pairs[:,1]]
+    d = np.hypot(X[a,0]-X[b,0], X[a,1]-X[b,1])/1e3
+    keep = (d > 0) & (d <= radius)
+    a, b, d = a[keep], b[keep], d[keep]
+
+    nb = csr_matrix((np.r_[d,d], (np.r_[a,b], np.r_[b,a])), shape=(len(xy), len(xy)))
+    with _cache_lock: _lru(_neighbour_cache, (tuple(xy), radius), ({x: i for i, x in enumerate(xy)}, nb), maxsize)
+    return nb
+
+def _tile_neighbours(X,core,halo,radius=5.0):
+    "This function returns a sparse (CSR) matrix of distances (in km) from the sites of a tile to the sites of its halo closer than `radius` km."
+    c = np.flatnonzero(np.isfinite(X[core]).all(axis=1))
+    h = halo[np.isfinite(X[halo]).all(axis=1)]
+
+    pairs = cKDTree(X[core[c]]).sparse_distance_matrix(cKDTree(X[h]), radius*1e3*(1+1e-9), output_type='ndarray')
+    a, b = c[pairs['i']], h[pairs['j']]
+    # same distances and cut-off as `neighbours`, so that the backoff is the same
+    d = np.hypot(X[core[a],0]-X[b,0], X[core[a],1]-X[b,1])/1e3
+    keep = (d > 0) & (d <= radius)
+
+    return csr_matrix((d[keep], (a[keep], pairs['j'][keep])), shape=(len(core), len(h)))
+
+def site_tiles(s_df,tile_size=20.0,radius=5.0):
+    "This function splits the sites into square tiles of `tile_size` km, yielding the sites of each tile and its halo of sites within `radius` km."
+
+    X = _project(*_site_lonlat(s_df))
+    ok = np.isfinite(X).all(axis=1)
+
+    # tiles at least `radius` wide, so that the halo of a tile lies in the 8 tiles around it
+    size = max(tile_size, radius)*1e3
+    pos = np.flatnonzero(ok)
+    cells, inv = np.unique(np.floor(X[pos]/size).astype(np.int64), axis=0, return_inverse=True)
+    tiles = np.split(pos[np.argsort(inv.ravel(), kind='stable')], np.cumsum(np.bincount(inv.ravel(), minlength=len(cells)))[:-1])
+    index = {cell: n for n, cell in enumerate(map(tuple, cells.tolist()))}
+
+    for (cx, cy), core in zip(index, tiles):
+        around = [tiles[index[(cx+dx, cy+dy)]] for dx in (-1,0,1) for dy in (-1,0,1)
+                  if (dx or dy) and (cx+dx, cy+dy) in index]
+        yield core, np.concatenate([core] + around)
+
+    # sites without a position have no neighbours
+    if not ok.all(): yield np.flatnonzero(~ok), np.flatnonzero(~ok)
+
+def _backoff(nb,backoff_factor):
+    "This function multiplies the backoff of all neighbours of each site."
+    nb = csr_matrix(nb)
+    bo = np.ones(nb.shape[0])
+    rows = np.repeat(np.arange(nb.shape[0]), np.diff(nb.indptr))
+    np.multiply.at(bo, rows, 1 - np.exp(-nb.data*backoff_factor))
+    return bo
+
+_backoff_cache = OrderedDict()
+
+def backoff_table(s_df,backoff_factor=1,s_df_distances=None,maxsize=8):
+    "This function returns the competition backoff of each site, cached on the site set and backoff factor."
+
+    if s_df_distances is not None:
+        di = np.asarray(s_df_distances, dtype=float)/1e3
+        return _backoff(np.where((di > 0) & (di <= 5.0), di, 0.0), backoff_factor)
+
+    key = (tuple(_site_key(s_df)), backoff_factor)
+    with _cache_lock:
+        if key in _backoff_cache:
+            _backoff_cache.move_to_end(key)
+            return _backoff_cache[key]
+
+    bo = _backoff(neighbours(s_df), backoff_factor)
+    with _cache_lock: return _lru(_backoff_cache, key, bo, maxsize)
+
+def clear_caches():
+    "This function empties the in-memory caches of workbooks, projections, grid joins, neighbours and backoff of this process."
+    with _cache_lock:
+        for cache in [_workbook_cache, _xy_cache, _grid_cache, _neighbour_cache, _backoff_cache]: cache.clear()
+        _transformer.cache_clear()
+
+def score_all(charging_type,r,s_df,s_df_distances=None,backoff=True,backoff_factor=1,sites=None,bo=None):
+    "This function computes the utilization scores of all sites, years and timeslots in one go."
+
+    if sites is None: sites = np.arange(s_df.shape[0])
+    sites = np.asarray(sites, dtype=int)
+
+    nv = np.asarray(s_df['num_vehicles'], dtype=float)[sites]
+    pj = np.array([r['pj'][k] for k in r['years_of_analysis']], dtype=float)
+
+    if charging_type=='destination_charing': backoff=False
+
+    if not backoff: bo = np.ones(len(sites))
+    elif bo is None: bo = backoff_table(s_df,backoff_factor,s_df_distances)[sites]
+    else: bo = np.asarray(bo, dtype=float)[sites]
+
+    retval = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for j in r['C']:
+            T = int(r['timeslots'][j])
+            tj = r['tj'][j]
+            Cij = np.asarray(r['Cij'][j], dtype=float)[sites][:,None,None]
+
+            dw = np.asarray(r['qjworking'][j][:T], dtype=float) * np.asarray(r['djworking'][j][:T], dtype=float)
+            dh = np.asarray(r['qjholiday'][j][:T], dtype=float) * np.asarray(r['djholiday'][j][:T], dtype=float)
+            nw = dw[None,None,:] * pj[None,:,None] * (nv*nv*bo)[:,None,None]
+            nh = dh[None,None,:] * pj[None,:,None] * (nv*nv*bo)[:,None,None]
+
+            tw = np.where(Cij > 0, nw * (tj/Cij), 0.0)
+            th = np.where(Cij > 0, nh * (tj/Cij), 0.0)
+
+            uw = np.where(tw <= tj, tw, tj)
+            uh = np.where(th <= tj, th, tj)
+
+            vw = np.where(tw > tj, (tw - tj) * (Cij/tj), 0.0)
+            vh = np.where(th > tj, (th - tj) * (Cij/tj), 0.0)
+
+            norm_vw = np.where(nw != 0, vw/nw, vw)
+            norm_vh = np.where(nh != 0, vh/nh, vh)
+
+            retval[j] = (uw/tj, uh/tj, norm_vw, norm_vh)
+
+    return retval
+
+def _tariff(r,j,g,rr):
+    "This function blends grid and renewable rates of a charger type over its timeslots."
+    T = int(r['timeslots'][j])
+    l = np.asarray(r['l'][j][:T], dtype=float)
+    return l * np.asarray(r[g][j][:T], dtype=float) + (1-l) * np.asarray(r[rr][j][:T], dtype=float)
+
 # %% ../01_model.ipynb 6
 def capex(r,i):
     "This function computes the capex requirements of each site"
@@ -65,105 +230,171 @@ def capex(r,i):
     return retval
 
 # %% ../01_model.ipynb 8
-def opex(charging_type,r,s_df,s_df_distances,i):
+def _energy(r,scores,sites,g,rr):
+    "This function weighs the utilization of each site with the hourly rates `g`/`rr`, summed over years, charger types and timeslots."
+    retval = np.zeros(len(sites))
+    for j in r['C']:
+        uw, uh, _, _ = scores[j]
+        Cij = np.asarray(r['Cij'][j], dtype=float)[sites]
+        retval += Cij * r['tj'][j] * r['Dj'][j] * ((300*uw + 65*uh) @ _tariff(r,j,g,rr)).sum(axis=1)
+    return retval
+
+def opex(charging_type,r,s_df,s_df_distances,i,scores=None):
     "This function computes the opex for each site."
     op_e = 0
     op_l = 0
 
-    for k in r['years_of_analysis']:
-        for j in r['C']:
-            for h in range(int(r['timeslots'][j])):
-                sw, sh, _, _ = score (charging_type,r,s_df,s_df_distances,j,i,h,k)
-                op_e += 300 * r['Cij'][j][i] * sw * r['tj'][j] * r['Dj'][j] * (r['l'][j][h] * r['Eg'][j][h] + (1-r['l'][j][h]) * r['Er'][j][h])
-                op_e +=  65 * r['Cij'][j][i] * sh * r['tj'][j] * r['Dj'][j] * (r['l'][j][h] * r['Eg'][j][h] + (1-r['l'][j][h]) * r['Er'][j][h])
+    # reuse the utilization of a previous score_all() over all sites if given
+    if scores is None: scores = score_all(charging_type,r,s_df,s_df_distances,sites=[i])
+    else: scores = {j: tuple(x[[i]] for x in v) for j, v in scores.items()}
+    op_e = _energy(r,scores,[i],'Eg','Er')[0]
     op_l = r['Li'][i] * r['Ai'][i] + r['CH'][i] + r['CK'][i]
     return op_e + op_l
 
 # %% ../01_model.ipynb 10
-def margin(charging_type,r,s_df,s_df_distances,i):
+def margin(charging_type,r,s_df,s_df_distances,i,scores=None):
     "This function computes the margins per site."
     margin_e = 0
     margin_l = 0
 
-    for k in r['years_of_analysis']:
-        for j in r['C']:
-            for h in range(int(r['timeslots'][j])):
-                sw, sh, _, _ = score (charging_type,r,s_df,s_df_distances,j,i,h,k)
-                margin_e += 300 * r['Cij'][j][i] * sw * r['tj'][j] * r['Dj'][j] * (r['l'][j][h] * r['Mg'][j][h] + (1-r['l'][j][h]) * r['Mr'][j][h])
-                margin_e +=  65 * r['Cij'][j][i] * sh * r['tj'][j] * r['Dj'][j] * (r['l'][j][h] * r['Mg'][j][h] + (1-r['l'][j][h]) * r['Mr'][j][h])
+    # reuse the utilization of a previous score_all() over all sites if given
+    if scores is None: scores = score_all(charging_type,r,s_df,s_df_distances,sites=[i])
+    else: scores = {j: tuple(x[[i]] for x in v) for j, v in scores.items()}
+    margin_e = _energy(r,scores,[i],'Mg','Mr')[0]
     margin_l = r['Bi'][i] * r['Ai'][i] + r['MH'][i] + r['MK'][i]
     return margin_e + margin_l
 
 # %% ../01_model.ipynb 12
-def run_analysis(charging_type,r,s_df,backoff_factor=1,sid="",aid="",cluster=False,stage=""):
-    "This function runs analysis for a given set of sites."
+def _run_chunk(charging_type,r,s_df,bo,sites):
+    "This function computes the utilization, costs and margins of a chunk of sites."
+
+    K = len(r['years_of_analysis'])
+    site = lambda x: np.asarray(x, dtype=float)[sites]
+
+    scores = score_all(charging_type,r,s_df,bo=bo,sites=sites)
+
+    # run through selected charger types
+    max_vehicles = np.round(sum(r['timeslots'][j]*site(r['Cij'][j]) for j in r['M']), 0)
+
+    # per site, year and charger type averages
+    chargertype_u_avg = np.stack([(300.0*scores[j][0].mean(axis=2) + 65.0*scores[j][1].mean(axis=2)) / 365.0 for j in r['C']], axis=2)
+    chargertype_v_avg = np.stack([(300.0*scores[j][2].mean(axis=2) + 65.0*scores[j][3].mean(axis=2)) / 365.0 for j in r['C']], axis=2)
+    year_u_avg = chargertype_u_avg.mean(axis=2)
+    year_v_avg = chargertype_v_avg.mean(axis=2)
+
+    site_capex = sum(site(r['Cij'][j])*r['Kj'][j] + site(r['Wi']) * site(r['di']) * site(r['Cij'][j]) for j in r['C'])
+    op_e = _energy(r,scores,sites,'Eg','Er')
+    op_l = K * (site(r['Li']) * site(r['Ai']) + site(r['CH']) + site(r['CK']))
+    margin_e = _energy(r,scores,sites,'Mg','Mr')
+    margin_l = K * (site(r['Bi']) * site(r['Ai']) + site(r['MH']) + site(r['MK']))
+
+    u_df = pd.DataFrame({'utilization': year_u_avg.mean(axis=1), 
+                         'unserviced': year_v_avg.mean(axis=1), 
+                         'capex': site_capex, 
+                         'opex': op_e + op_l, 
+                         'margin': margin_e + margin_l, 
+                         'max vehicles': max_vehicles, 
+                         'estimated vehicles': np.round(year_u_avg.mean(axis=1)*max_vehicles,0)
+                         }, index=sites)
+    return u_df
+
+def site_globals(r:Globals,sites) -> Globals:
+    "This function returns a copy of `r` with the per-site globals of the given `sites` (positions), e.g. for the cluster episode."
+    r = Globals(r)
+    r['Cij'] = {j: np.asarray(v)[sites] for j, v in r['Cij'].items()}
+    for k in ('di','Gi','Ri','Wi','Ai','Li','Bi','CH','CK','MH','MK'):
+        if k in r: r[k] = np.asarray(r[k])[sites]
+    r['Nc'] = len(sites)
+    return r
+
+def _stale_sites(s_df,previous):
+    "This function flags the sites whose results cannot be reused from a previous episode on a superset of sites."
+
+    origin, prev_s_df, prev_u_df = previous
+    origin = np.asarray(origin, dtype=int)
+
+    # with the globals taken at `origin`, a site's results only change if some of its neighbours were dropped
+    nnz = lambda nb: np.diff(nb.indptr)
+    return nnz(neighbours(s_df)) != nnz(neighbours(prev_s_df))[origin]
+
+def _progress(done,Nc,cluster,stage):
+    "This function returns the progress (in %) of the analysis after `done` out of `Nc` sites."
+    # an episode without sites is complete
+    frac = done/Nc if Nc else 1.0
+    if cluster==True and stage=="initial": return (frac*100)/2
+    elif stage=="cluster": return 50+(frac*100)/2
+    elif cluster==False: return frac*100
+
+# read-only inputs shared by all chunks of a worker process
+_worker = {}
+
+def _init_worker(charging_type,r,s_df,bo):
+    "This function receives the shared inputs once per worker process."
+    _worker.update(charging_type=charging_type, r=r, s_df=s_df, bo=bo)
+
+def _worker_chunk(sites):
+    "This function analyzes a chunk of sites in a worker process."
+    return _run_chunk(_worker['charging_type'],_worker['r'],_worker['s_df'],_worker['bo'],sites)
+
+def run_analysis(charging_type,r,s_df,backoff_factor=1,sid="",aid="",cluster=False,stage="",workers=1,chunksize=256,previous=None,progress=None):
+    "This function runs analysis for a given set of sites, reusing the `previous` results of unaffected sites and reporting to `progress(charging_type, prog)`."
 
     #r = read_globals(m,s,t,g,p,charging_type,ui_inputs)
     
-    u_df = pd.DataFrame(columns=['utilization', 
-                             'unserviced', 
-                             'capex', 
-                             'opex', 
-                             'margin', 
-                             'max vehicles', 
-                             'estimated vehicles'
-                             ])    
-    s_df_crs = gpd.GeoDataFrame(s_df, crs='EPSG:4326')
-    s_df_crs = s_df_crs.to_crs('EPSG:5234')
-    s_df_distances = s_df_crs.geometry.apply(lambda g: s_df_crs.distance(g))      
-    
     Nc = s_df.shape[0]
-    
-    for i in tqdm(range(Nc)):
-        if cluster==True and stage=="initial":prog=((i/Nc)*100)/2
-        elif stage=="cluster":prog=50+((i/Nc)*100)/2
-        elif cluster==False :prog=(i/Nc)*100
-        
-        max_vehicles = 0
-        # run through selected charger types
-        for j in r['M']:
-            max_vehicles += r['timeslots'][j]*r['Cij'][j][i]
-        max_vehicles = int(np.round(max_vehicles,0))
-        op_e = 0
-        op_l = 0
-        margin_e = 0
-        margin_l = 0
-        year_u_avg = np.array([])
-        year_v_avg = np.array([])
-        for k in r['years_of_analysis']:
-            chargertype_u_avg = np.array([])
-            chargertype_v_avg = np.array([])
-            for j in r['C']:
-                uw_day_avg = np.array([])
-                uh_day_avg = np.array([])
-                vw_day_avg = np.array([])
-                vh_day_avg = np.array([])              
-                for h in range(int(r['timeslots'][j])):
-                    uw, uh, vw, vh = score (charging_type,r,s_df,s_df_distances,j,i,h,k,backoff_factor=backoff_factor)
-                    uw_day_avg = np.append(uw_day_avg, uw)
-                    uh_day_avg = np.append(uh_day_avg, uh)
-                    vw_day_avg = np.append(vw_day_avg, vw)
-                    vh_day_avg = np.append(vh_day_avg, vh)                  
-                    op_e += 300 * r['Cij'][j][i] * uw * r['tj'][j] * r['Dj'][j] * (r['l'][j][h] * r['Eg'][j][h] + (1-r['l'][j][h]) * r['Er'][j][h])
-                    op_e +=  65 * r['Cij'][j][i] * uh * r['tj'][j] * r['Dj'][j] * (r['l'][j][h] * r['Eg'][j][h] + (1-r['l'][j][h]) * r['Er'][j][h])            
-                    margin_e += 300 * r['Cij'][j][i] * uw * r['tj'][j] * r['Dj'][j] * (r['l'][j][h] * r['Mg'][j][h] + (1-r['l'][j][h]) * r['Mr'][j][h])
-                    margin_e +=  65 * r['Cij'][j][i] * uh * r['tj'][j] * r['Dj'][j] * (r['l'][j][h] * r['Mg'][j][h] + (1-r['l'][j][h]) * r['Mr'][j][h])        
-                weighted_u = (300.0*uw_day_avg.mean() + 65.0*uh_day_avg.mean()) / 365.0
-                weighted_v = (300.0*vw_day_avg.mean() + 65.0*vh_day_avg.mean()) / 365.0
-                chargertype_u_avg = np.append(chargertype_u_avg, weighted_u)
-                chargertype_v_avg = np.append(chargertype_v_avg, weighted_v)
-            year_u_avg = np.append(year_u_avg, chargertype_u_avg.mean())
-            year_v_avg = np.append(year_v_avg, chargertype_v_avg.mean())
-            op_l += r['Li'][i] * r['Ai'][i] + r['CH'][i] + r['CK'][i]
-            margin_l += r['Bi'][i] * r['Ai'][i] + r['MH'][i] + r['MK'][i]
-        site_capex = capex(r,i)
-        estimated_vehicles = np.round(year_u_avg.mean()*max_vehicles,0)
-        u_df.loc[i] = [ year_u_avg.mean(), 
-                       year_v_avg.mean(),
-                       site_capex,
-                       op_e + op_l,
-                       margin_e + margin_l,
-                       max_vehicles,
-                       estimated_vehicles
-                       ]
+
+    with span('backoff', charging_type=charging_type, episode=stage):
+        bo = backoff_table(s_df,backoff_factor)
+
+        # previous = (position of each site in prev_s_df, prev_s_df, prev_u_df), with `r` taken at those positions (see site_globals)
+        todo, reused = np.arange(Nc), []
+        if previous is not None and Nc > 0:
+            stale = _stale_sites(s_df,previous)
+            todo = np.flatnonzero(stale)
+            cols = ['utilization','unserviced','capex','opex','margin','max vehicles','estimated vehicles']
+            reused = [previous[2].loc[np.asarray(previous[0])[~stale], cols].set_axis(np.flatnonzero(~stale))]
+            print(f'Reusing {Nc-len(todo)} of {Nc} sites')
+
+    chunks = np.array_split(todo, max(1, -(-len(todo)//chunksize)))
+    results = [None]*len(chunks)
+
+    with span('scoring', charging_type=charging_type, episode=stage), tqdm(total=Nc, initial=Nc-len(todo)) as bar:
+        if workers > 1 and len(chunks) > 1:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(charging_type,r,s_df[['num_vehicles']],bo)) as pool:
+                futures = {pool.submit(_worker_chunk, sites): n for n, sites in enumerate(chunks)}
+                for f in as_completed(futures):
+                    results[futures[f]] = f.result()
+                    bar.update(results[futures[f]].shape[0])
+                    prog = _progress(bar.n,Nc,cluster,stage)
+                    if progress is not None: progress(charging_type, prog)
+        else:
+            for n, sites in enumerate(chunks):
+                results[n] = _run_chunk(charging_type,r,s_df,bo,sites)
+                bar.update(len(sites))
+                prog = _progress(bar.n,Nc,cluster,stage)
+                if progress is not None: progress(charging_type, prog)
+
+    u_df = pd.concat(reused + results).sort_index()
     return u_df
+
+def stream_analysis(charging_type,r,s_df,backoff_factor=1,tile_size=20.0,cluster=False,stage="",chunksize=256,progress=None):
+    "This function runs analysis tile by tile, yielding the sites of each tile with their results so that only one tile is held in memory."
+
+    Nc = s_df.shape[0]
+    done = 0
+    bo = np.ones(Nc)
+    X = _project(*_site_lonlat(s_df))
+
+    for core, halo in site_tiles(s_df,tile_size):
+        with span('backoff', charging_type=charging_type, episode=stage):
+            # the halo holds every neighbour of the tile's sites, so their backoff is the same as over all sites
+            bo[core] = _backoff(_tile_neighbours(X,core,halo), backoff_factor)
+
+        with span('scoring', charging_type=charging_type, episode=stage):
+            chunks = np.array_split(core, max(1, -(-len(core)//chunksize)))
+            u_df = pd.concat([_run_chunk(charging_type,r,s_df,bo,sites) for sites in chunks])
+
+        done += len(core)
+        if progress is not None: progress(charging_type, _progress(done,Nc,cluster,stage))
+        yield core, u_df
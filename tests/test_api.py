@@ -0,0 +1,88 @@
+import sqlite3, threading, time
+
+import pytest
+
+pytest.importorskip('mysql.connector')
+import api
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    "A sqlite stand-in behind a pool of one connection, counting the connections open at once."
+    path = str(tmp_path / 'evci.sqlite')
+    with sqlite3.connect(path) as c: c.execute("create table t (job INTEGER)")
+
+    state = {'open': 0, 'max_open': 0}
+    lock = threading.Lock()
+
+    class Connection:
+        def __init__(self):
+            self.conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+            with lock:
+                state['open'] += 1
+                state['max_open'] = max(state['max_open'], state['open'])
+        def __getattr__(self, name): return getattr(self.conn, name)
+        def close(self):
+            with lock: state['open'] -= 1
+            self.conn.close()
+
+    monkeypatch.setattr(api, 'connection_factory', Connection)
+    monkeypatch.setattr(api, 'db_paramstyle', 'qmark')
+    monkeypatch.setattr(api, 'db_slots', threading.BoundedSemaphore(1))
+    return path, state
+
+
+def test_connection_waits_for_a_free_one(db):
+    path, state = db
+    borrowed, release = threading.Event(), threading.Event()
+
+    def hold():
+        with api.connection():
+            borrowed.set()
+            release.wait()
+
+    t = threading.Thread(target=hold)
+    t.start()
+    borrowed.wait()
+    threading.Timer(0.3, release.set).start()
+
+    t0 = time.perf_counter()
+    with api.connection() as mydb:
+        mydb.cursor().execute(api.sql("insert into t values (%s)"), (1,))
+        mydb.commit()
+    t.join()
+
+    assert time.perf_counter() - t0 >= 0.25
+    assert state == {'open': 0, 'max_open': 1}
+
+
+def test_connection_times_out_when_none_is_returned(db, monkeypatch):
+    monkeypatch.setattr(api, 'DB_POOL_TIMEOUT', 0.1)
+    with api.connection():
+        with pytest.raises(TimeoutError):
+            with api.connection(): pass
+    # the slot is free again afterwards
+    with api.connection(): pass
+
+
+def test_more_jobs_than_connections(db):
+    path, state = db
+    errors = []
+
+    def job(n):
+        try:
+            with api.connection() as mydb:
+                cursor = mydb.cursor()
+                api.execute_batched(cursor, "insert into t values (%s)", [(n,)]*3)
+                mydb.commit()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=job, args=(n,)) for n in range(8)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+
+    assert errors == []
+    assert state['max_open'] == 1
+    with sqlite3.connect(path) as c:
+        assert c.execute("select count(*), count(distinct job) from t").fetchone() == (24, 8)